@@ -0,0 +1,30 @@
+"""Index unclaimed work
+
+Revision ID: 1f3a7c2d9e4
+Revises: 3fec283e512
+Create Date: 2026-10-18 09:12:41.305114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f3a7c2d9e4'
+down_revision = '3fec283e512'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('''
+        CREATE INDEX IF NOT EXISTS work_table_unclaimed_idx
+        ON work_table (updated)
+        WHERE claimed = FALSE
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_unclaimed_idx
+    ''')
@@ -0,0 +1,52 @@
+"""Work priority and lanes
+
+Revision ID: 2d6e91b7a35
+Revises: 52b8e0d4c6a
+Create Date: 2026-10-18 11:20:45.117392
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d6e91b7a35'
+down_revision = '52b8e0d4c6a'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('work_table', sa.Column('created', sa.DateTime(timezone=True), server_default=sa.text('NOW()'), nullable=True))
+    op.add_column('work_table', sa.Column('priority', sa.Integer(), server_default=sa.text('0'), nullable=True))
+    op.add_column('work_table', sa.Column('lane', sa.String(length=255), server_default=sa.text("'default'"), nullable=True))
+    op.add_column('work_table', sa.Column('max_concurrency', sa.Integer(), nullable=True))
+
+    op.execute('''
+        UPDATE work_table SET
+          created = updated
+    ''')
+
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_unclaimed_idx
+    ''')
+    op.execute('''
+        CREATE INDEX work_table_unclaimed_idx
+        ON work_table (priority DESC, created)
+        WHERE claimed = FALSE
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_unclaimed_idx
+    ''')
+    op.execute('''
+        CREATE INDEX work_table_unclaimed_idx
+        ON work_table (updated)
+        WHERE claimed = FALSE
+    ''')
+    op.drop_column('work_table', 'max_concurrency')
+    op.drop_column('work_table', 'lane')
+    op.drop_column('work_table', 'priority')
+    op.drop_column('work_table', 'created')
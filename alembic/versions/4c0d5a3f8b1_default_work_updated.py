@@ -0,0 +1,24 @@
+"""Default work updated
+
+Revision ID: 4c0d5a3f8b1
+Revises: 2d6e91b7a35
+Create Date: 2026-10-18 12:05:33.410956
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c0d5a3f8b1'
+down_revision = '2d6e91b7a35'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.alter_column('work_table', 'updated', server_default=sa.text('NOW()'))
+
+
+def downgrade():
+    op.alter_column('work_table', 'updated', server_default=None)
@@ -0,0 +1,56 @@
+"""Work leases and retries
+
+Revision ID: 52b8e0d4c6a
+Revises: 1f3a7c2d9e4
+Create Date: 2026-10-18 10:02:17.884310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52b8e0d4c6a'
+down_revision = '1f3a7c2d9e4'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('work_table', sa.Column('failed', sa.Boolean(), server_default=sa.text('FALSE'), nullable=True))
+    op.add_column('work_table', sa.Column('attempts', sa.Integer(), server_default=sa.text('0'), nullable=True))
+    op.add_column('work_table', sa.Column('max_attempts', sa.Integer(), server_default=sa.text('1'), nullable=True))
+    op.add_column('work_table', sa.Column('retry_backoff', sa.Integer(), server_default=sa.text('30'), nullable=True))
+    op.add_column('work_table', sa.Column('lease_expires', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('work_table', sa.Column('run_after', sa.DateTime(timezone=True), nullable=True))
+
+    # Anything that already blew up before there were retries stays failed
+    op.execute('''
+        UPDATE work_table SET
+          failed = TRUE,
+          attempts = 1
+        WHERE claimed = TRUE
+          AND completed = FALSE
+          AND traceback IS NOT NULL
+    ''')
+
+    # Anything claimed that hadn't finished or blown up was left behind by a
+    # worker that went away. Give it an expired lease so that it's picked
+    # up again like any other job whose worker died.
+    op.execute('''
+        UPDATE work_table SET
+          lease_expires = NOW()
+        WHERE claimed = TRUE
+          AND completed = FALSE
+          AND failed = FALSE
+          AND traceback IS NULL
+    ''')
+
+
+def downgrade():
+    op.drop_column('work_table', 'run_after')
+    op.drop_column('work_table', 'lease_expires')
+    op.drop_column('work_table', 'retry_backoff')
+    op.drop_column('work_table', 'max_attempts')
+    op.drop_column('work_table', 'attempts')
+    op.drop_column('work_table', 'failed')
@@ -0,0 +1,30 @@
+"""Work fan out
+
+Revision ID: 5e7b2c9a104
+Revises: 4c0d5a3f8b1
+Create Date: 2026-10-18 13:41:08.552027
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e7b2c9a104'
+down_revision = '4c0d5a3f8b1'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('work_table', sa.Column('parent_key', sa.String(), nullable=True))
+    op.add_column('work_table', sa.Column('children_total', sa.Integer(), nullable=True))
+    op.add_column('work_table', sa.Column('children_done', sa.Integer(), nullable=True))
+    op.add_column('work_table', sa.Column('children_failed', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('work_table', 'children_failed')
+    op.drop_column('work_table', 'children_done')
+    op.drop_column('work_table', 'children_total')
+    op.drop_column('work_table', 'parent_key')
@@ -0,0 +1,32 @@
+"""Work coalesce key
+
+Revision ID: 6a93f1d2e58
+Revises: 5e7b2c9a104
+Create Date: 2026-10-18 14:26:51.093774
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a93f1d2e58'
+down_revision = '5e7b2c9a104'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('work_table', sa.Column('coalesce_key', sa.String(), nullable=True))
+    op.execute('''
+        CREATE INDEX work_table_coalesce_idx
+        ON work_table (coalesce_key)
+        WHERE completed = FALSE AND failed = FALSE
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_coalesce_idx
+    ''')
+    op.drop_column('work_table', 'coalesce_key')
@@ -0,0 +1,184 @@
+"""Partition work table
+
+Revision ID: 7c4e8b0a2f6
+Revises: 6a93f1d2e58
+Create Date: 2026-10-18 15:38:12.670243
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c4e8b0a2f6'
+down_revision = '6a93f1d2e58'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+COLUMNS = '''
+    key,
+    return_value,
+    work_value,
+    traceback,
+    task_name,
+    updated,
+    claimed,
+    cleared,
+    completed,
+    failed,
+    attempts,
+    max_attempts,
+    retry_backoff,
+    lease_expires,
+    run_after,
+    created,
+    priority,
+    lane,
+    max_concurrency,
+    parent_key,
+    children_total,
+    children_done,
+    children_failed,
+    coalesce_key
+'''
+
+def upgrade():
+    # Needs PostgreSQL 11 or later for primary keys, indexes and default
+    # partitions on partitioned tables.
+    op.execute('''
+        ALTER TABLE work_table RENAME TO work_table_old
+    ''')
+    op.execute('''
+        ALTER TABLE work_table_old
+        RENAME CONSTRAINT work_table_pkey TO work_table_old_pkey
+    ''')
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_unclaimed_idx
+    ''')
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_coalesce_idx
+    ''')
+
+    op.execute('''
+        CREATE TABLE work_table (
+          key VARCHAR NOT NULL,
+          return_value JSONB,
+          work_value BYTEA,
+          traceback TEXT,
+          task_name VARCHAR(255),
+          updated TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+          claimed BOOLEAN DEFAULT FALSE,
+          cleared BOOLEAN DEFAULT TRUE,
+          completed BOOLEAN DEFAULT FALSE,
+          failed BOOLEAN DEFAULT FALSE,
+          attempts INTEGER DEFAULT 0,
+          max_attempts INTEGER DEFAULT 1,
+          retry_backoff INTEGER DEFAULT 30,
+          lease_expires TIMESTAMP WITH TIME ZONE,
+          run_after TIMESTAMP WITH TIME ZONE,
+          created TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+          priority INTEGER DEFAULT 0,
+          lane VARCHAR(255) DEFAULT 'default',
+          max_concurrency INTEGER,
+          parent_key VARCHAR,
+          children_total INTEGER,
+          children_done INTEGER,
+          children_failed INTEGER,
+          coalesce_key VARCHAR,
+          PRIMARY KEY (key, created)
+        ) PARTITION BY RANGE (created)
+    ''')
+
+    op.execute('''
+        UPDATE work_table_old SET
+          created = COALESCE(created, updated, NOW())
+        WHERE created IS NULL
+    ''')
+
+    # A partition for every month from the oldest job through a couple of
+    # months from now. The queue daemon keeps adding them after that.
+    op.execute('''
+        DO $$
+        DECLARE
+          partition_start TIMESTAMP;
+        BEGIN
+          FOR partition_start IN
+            SELECT generate_series(
+              date_trunc('month', LEAST(MIN(created), NOW()) AT TIME ZONE 'UTC'),
+              date_trunc('month', NOW() AT TIME ZONE 'UTC') + INTERVAL '2 months',
+              INTERVAL '1 month'
+            )
+            FROM work_table_old
+          LOOP
+            EXECUTE format(
+              'CREATE TABLE %I PARTITION OF work_table
+               FOR VALUES FROM (%L) TO (%L)',
+              to_char(partition_start, '"work_table_y"YYYY"m"MM'),
+              partition_start::TEXT || '+00',
+              (partition_start + INTERVAL '1 month')::TEXT || '+00'
+            );
+          END LOOP;
+        END
+        $$
+    ''')
+
+    op.execute('''
+        CREATE TABLE work_table_default PARTITION OF work_table DEFAULT
+    ''')
+
+    op.execute('''
+        INSERT INTO work_table ({0})
+        SELECT {0} FROM work_table_old
+    '''.format(COLUMNS))
+
+    op.execute('''
+        DROP TABLE work_table_old
+    ''')
+
+    op.execute('''
+        CREATE INDEX work_table_unclaimed_idx
+        ON work_table (priority DESC, created)
+        WHERE claimed = FALSE
+    ''')
+    op.execute('''
+        CREATE INDEX work_table_coalesce_idx
+        ON work_table (coalesce_key)
+        WHERE completed = FALSE AND failed = FALSE
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        ALTER TABLE work_table RENAME TO work_table_partitioned
+    ''')
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_unclaimed_idx
+    ''')
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_coalesce_idx
+    ''')
+    op.execute('''
+        CREATE TABLE work_table (
+          LIKE work_table_partitioned INCLUDING DEFAULTS
+        )
+    ''')
+    op.execute('''
+        INSERT INTO work_table ({0})
+        SELECT {0} FROM work_table_partitioned
+    '''.format(COLUMNS))
+    op.execute('''
+        DROP TABLE work_table_partitioned
+    ''')
+    op.execute('''
+        ALTER TABLE work_table ADD PRIMARY KEY (key)
+    ''')
+    op.execute('''
+        CREATE INDEX work_table_unclaimed_idx
+        ON work_table (priority DESC, created)
+        WHERE claimed = FALSE
+    ''')
+    op.execute('''
+        CREATE INDEX work_table_coalesce_idx
+        ON work_table (coalesce_key)
+        WHERE completed = FALSE AND failed = FALSE
+    ''')
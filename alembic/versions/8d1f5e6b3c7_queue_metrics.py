@@ -0,0 +1,45 @@
+"""Queue metrics
+
+Revision ID: 8d1f5e6b3c7
+Revises: 7c4e8b0a2f6
+Create Date: 2026-10-18 16:52:29.738115
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d1f5e6b3c7'
+down_revision = '7c4e8b0a2f6'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+def upgrade():
+    op.add_column('work_table', sa.Column('claimed_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('work_table', sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True))
+    op.execute('''
+        CREATE INDEX work_table_active_idx
+        ON work_table (task_name)
+        WHERE completed = FALSE AND failed = FALSE
+    ''')
+    op.create_table('queue_worker',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('hostname', sa.String(), nullable=True),
+    sa.Column('pid', sa.Integer(), nullable=True),
+    sa.Column('lanes', postgresql.ARRAY(sa.String()), nullable=True),
+    sa.Column('started', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('last_seen', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('current_key', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('queue_worker')
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_active_idx
+    ''')
+    op.drop_column('work_table', 'finished_at')
+    op.drop_column('work_table', 'claimed_at')
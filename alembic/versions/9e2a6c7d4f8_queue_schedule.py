@@ -0,0 +1,45 @@
+"""Queue schedule
+
+Revision ID: 9e2a6c7d4f8
+Revises: 8d1f5e6b3c7
+Create Date: 2026-10-18 18:10:44.205381
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e2a6c7d4f8'
+down_revision = '8d1f5e6b3c7'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+def upgrade():
+    op.create_table('queue_schedule',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('last_run', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('next_run', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.create_table('task_progress',
+    sa.Column('form_id', sa.Integer(), nullable=False),
+    sa.Column('progress', postgresql.JSONB(), nullable=True),
+    sa.Column('updated', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['form_id'], ['form_meta.id'], ),
+    sa.PrimaryKeyConstraint('form_id')
+    )
+    op.execute('''
+        CREATE INDEX image_task_assignment_checkout_idx
+        ON image_task_assignment (checkout_expire)
+        WHERE checkout_expire IS NOT NULL
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        DROP INDEX IF EXISTS image_task_assignment_checkout_idx
+    ''')
+    op.drop_table('task_progress')
+    op.drop_table('queue_schedule')
@@ -0,0 +1,33 @@
+"""Image object
+
+Revision ID: a1c3e5f7b92
+Revises: 9e2a6c7d4f8
+Create Date: 2026-10-18 19:02:17.530912
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f7b92'
+down_revision = '9e2a6c7d4f8'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+def upgrade():
+    op.create_table('image_object',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('election_name', sa.String(), nullable=True),
+    sa.Column('image_id', postgresql.UUID(), nullable=True),
+    sa.Column('etag', sa.String(), nullable=True),
+    sa.Column('last_modified', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_image_object_election_name'), 'image_object', ['election_name'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_image_object_election_name'), table_name='image_object')
+    op.drop_table('image_object')
@@ -0,0 +1,30 @@
+"""Image sync checkpoint
+
+Revision ID: b2d4f6a8c13
+Revises: a1c3e5f7b92
+Create Date: 2026-10-18 19:41:52.118304
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b2d4f6a8c13'
+down_revision = 'a1c3e5f7b92'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+def upgrade():
+    op.create_table('image_sync_checkpoint',
+    sa.Column('range_key', sa.String(), nullable=False),
+    sa.Column('last_key', sa.String(), nullable=True),
+    sa.Column('report', postgresql.JSONB(), nullable=True),
+    sa.Column('updated', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('range_key')
+    )
+
+
+def downgrade():
+    op.drop_table('image_sync_checkpoint')
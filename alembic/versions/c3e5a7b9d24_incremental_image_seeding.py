@@ -0,0 +1,28 @@
+"""Incremental image seeding
+
+Revision ID: c3e5a7b9d24
+Revises: b2d4f6a8c13
+Create Date: 2026-10-18 20:16:08.442871
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3e5a7b9d24'
+down_revision = 'b2d4f6a8c13'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+def upgrade():
+    op.add_column('image', sa.Column('added', sa.DateTime(timezone=True), server_default=sa.text('NOW()'), nullable=True))
+    op.create_index(op.f('ix_image_added'), 'image', ['added'], unique=False)
+    op.add_column('form_meta', sa.Column('images_seeded_through', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column('form_meta', 'images_seeded_through')
+    op.drop_index(op.f('ix_image_added'), table_name='image')
+    op.drop_column('image', 'added')
@@ -0,0 +1,29 @@
+"""Index image object keys in S3 order
+
+Revision ID: d4f6b8c1e35
+Revises: c3e5a7b9d24
+Create Date: 2026-10-18 22:41:09.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd4f6b8c1e35'
+down_revision = 'c3e5a7b9d24'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('''
+        CREATE INDEX IF NOT EXISTS image_object_election_key_idx
+        ON image_object (election_name, key COLLATE "C")
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        DROP INDEX IF EXISTS image_object_election_key_idx
+    ''')
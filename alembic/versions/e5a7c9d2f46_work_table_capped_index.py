@@ -0,0 +1,32 @@
+"""Index unfinished capped work
+
+Revision ID: e5a7c9d2f46
+Revises: d4f6b8c1e35
+Create Date: 2026-10-18 23:05:37.204518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5a7c9d2f46'
+down_revision = 'd4f6b8c1e35'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('''
+        CREATE INDEX IF NOT EXISTS work_table_capped_idx
+        ON work_table (task_name)
+        WHERE max_concurrency IS NOT NULL
+          AND completed = FALSE
+          AND failed = FALSE
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        DROP INDEX IF EXISTS work_table_capped_idx
+    ''')
@@ -0,0 +1,798 @@
+import os
+import sys
+import time
+import json
+import shutil
+import hashlib
+import bisect
+import tempfile
+import resource
+import threading
+import tracemalloc
+from io import BytesIO
+from uuid import uuid4
+from datetime import datetime, timezone
+
+import sqlalchemy as sa
+
+from botocore.exceptions import ClientError
+
+# Runs the image ingest code against stand-ins for S3 and Google Drive so
+# that we can see how fast it goes without touching the real buckets. It
+# does need a real Postgres to write to. Point --db-conn at a scratch
+# database, it gets the tables it needs created in it and everything with
+# an election name starting with "bench-" is cleared out between runs.
+
+
+class FakeS3(object):
+    '''
+    Just enough of the boto3 S3 client for ImageUpdater and SyncGoogle,
+    keeping the objects in memory. latency is added to every request to
+    stand in for the round trip to S3.
+    '''
+
+    def __init__(self, latency=0, page_size=1000):
+        self.latency = latency
+        self.page_size = page_size
+        self.objects = {}
+        self.keys = []
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_object(self, Bucket=None, Key=None, Body=b'', Metadata=None, **kwargs):
+        self.request()
+
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+
+        etag = '"{}"'.format(hashlib.md5(Body).hexdigest())
+
+        obj = {
+            'Key': Key,
+            'Size': len(Body),
+            'ETag': etag,
+            'LastModified': datetime.now(timezone.utc).replace(microsecond=0),
+            'Metadata': dict(Metadata or {}),
+        }
+
+        with self.lock:
+            if Key not in self.objects:
+                bisect.insort(self.keys, Key)
+
+            self.objects[Key] = obj
+
+        return {'ETag': etag}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        extra = ExtraArgs or {}
+        self.put_object(Bucket=Bucket,
+                        Key=Key,
+                        Body=Fileobj.read(),
+                        Metadata=extra.get('Metadata'))
+
+    def head_object(self, Bucket=None, Key=None):
+        self.request()
+
+        obj = self.objects.get(Key)
+
+        if obj is None:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}},
+                              'HeadObject')
+
+        return {
+            'ETag': obj['ETag'],
+            'ContentLength': obj['Size'],
+            'LastModified': obj['LastModified'],
+            'Metadata': obj['Metadata'],
+        }
+
+    def list_objects_v2(self,
+                        Bucket=None,
+                        Prefix='',
+                        Delimiter=None,
+                        StartAfter=None,
+                        ContinuationToken=None,
+                        MaxKeys=None):
+        self.request()
+
+        max_keys = MaxKeys or self.page_size
+
+        with self.lock:
+            # Our continuation tokens are just where we got to in self.keys
+            if ContinuationToken:
+                position = int(ContinuationToken)
+            else:
+                position = bisect.bisect_right(self.keys, StartAfter or '')
+                position = max(position, bisect.bisect_left(self.keys, Prefix))
+
+            contents = []
+            prefixes = []
+
+            while position < len(self.keys) and len(contents) + len(prefixes) < max_keys:
+                key = self.keys[position]
+
+                if not key.startswith(Prefix):
+                    break
+
+                rest = key[len(Prefix):]
+
+                if Delimiter and Delimiter in rest:
+                    prefix = Prefix + rest.split(Delimiter, 1)[0] + Delimiter
+                    prefixes.append({'Prefix': prefix})
+
+                    # Skip over the rest of the keys rolled up under it
+                    after = prefix[:-1] + chr(ord(Delimiter) + 1)
+                    position = bisect.bisect_left(self.keys, after)
+                    continue
+
+                obj = self.objects[key]
+                contents.append({
+                    'Key': key,
+                    'Size': obj['Size'],
+                    'ETag': obj['ETag'],
+                    'LastModified': obj['LastModified'],
+                })
+
+                position += 1
+
+            truncated = position < len(self.keys) and self.keys[position].startswith(Prefix)
+
+        response = {
+            'IsTruncated': truncated,
+            'KeyCount': len(contents) + len(prefixes),
+        }
+
+        if contents:
+            response['Contents'] = contents
+
+        if prefixes:
+            response['CommonPrefixes'] = prefixes
+
+        if truncated:
+            response['NextContinuationToken'] = str(position)
+
+        return response
+
+
+class FakeDriveResponse(dict):
+    def __init__(self, status, headers):
+        super().__init__(headers)
+        self.status = status
+        self.reason = 'OK'
+
+
+class FakeDriveHttp(object):
+    '''
+    Serves file contents for MediaIoBaseDownload, honouring the range
+    header it sends so that chunked downloads work like the real thing.
+    '''
+
+    def __init__(self, drive):
+        self.drive = drive
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        self.drive.request()
+
+        body = self.drive.contents[uri.rsplit('/', 1)[-1]]
+
+        start, end = 0, len(body) - 1
+
+        byte_range = (headers or {}).get('range')
+
+        if byte_range:
+            start, end = [int(b) for b in byte_range.split('=', 1)[1].split('-')]
+            end = min(end, len(body) - 1)
+
+        headers = {
+            'content-range': 'bytes {0}-{1}/{2}'.format(start, end, len(body)),
+        }
+
+        return FakeDriveResponse(206, headers), body[start:end + 1]
+
+
+class FakeDriveMediaRequest(object):
+    def __init__(self, drive, file_id):
+        self.http = FakeDriveHttp(drive)
+        self.uri = 'fake://drive/{}'.format(file_id)
+        self.headers = {}
+
+
+class FakeDriveRequest(object):
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self, **kwargs):
+        return self.result
+
+
+class FakeDriveFiles(object):
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, q='', orderBy=None, pageToken=None, pageSize=100, fields=None):
+        self.drive.request()
+
+        if q.startswith('name contains '):
+            name = q.split("'")[1]
+            matches = [f for f in self.drive.folders if name in f['name']]
+        elif q.startswith('name = '):
+            name = q.split("'")[1]
+            matches = [f for f in self.drive.drive_files.values() if f['name'] == name]
+        elif q.endswith(' in parents'):
+            folder_id = q.split("'")[1]
+            matches = self.drive.children.get(folder_id, [])
+        else:
+            raise ValueError('Unsupported query {}'.format(q))
+
+        start = int(pageToken or 0)
+        page = matches[start:start + pageSize]
+
+        result = {'files': page}
+
+        if start + pageSize < len(matches):
+            result['nextPageToken'] = str(start + pageSize)
+
+        return FakeDriveRequest(result)
+
+    def get_media(self, fileId=None):
+        return FakeDriveMediaRequest(self.drive, fileId)
+
+
+class FakeDrive(object):
+    '''
+    Stands in for the Drive v3 service that SyncGoogle builds.
+    '''
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.folders = []
+        self.drive_files = {}
+        self.children = {}
+        self.contents = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def addFolder(self, name):
+        folder = {
+            'id': str(uuid4()),
+            'name': name,
+            'mimeType': 'application/vnd.google-apps.folder',
+        }
+
+        self.folders.append(folder)
+        self.children[folder['id']] = []
+
+        return folder['id']
+
+    def addFile(self, folder_id, name, body):
+        drive_file = {
+            'id': str(uuid4()),
+            'name': name,
+            'mimeType': 'image/jpeg',
+            'md5Checksum': hashlib.md5(body).hexdigest(),
+            'size': str(len(body)),
+        }
+
+        self.drive_files[drive_file['id']] = drive_file
+        self.children[folder_id].append(drive_file)
+        self.contents[drive_file['id']] = body
+
+    def sortChildren(self):
+        for children in self.children.values():
+            children.sort(key=lambda f: f['name'])
+
+    def files(self):
+        return FakeDriveFiles(self)
+
+
+def hierarchyFor(index, depth, branching):
+    levels = []
+
+    for level in range(depth):
+        place = branching ** (depth - level - 1)
+        levels.append('l{0}-{1}'.format(level, (index // place) % branching))
+
+    return levels
+
+
+def fillBucket(s3, elections, keys_per_election, depth, branching):
+    '''
+    Add keys_per_election PDFs to each of the elections, laid out the way
+    SyncGoogle leaves them.
+    '''
+
+    body = b'%PDF-1.3 benchmark'
+
+    for election in elections:
+        for index in range(keys_per_election):
+            hierarchy = hierarchyFor(index, depth, branching) + [str(index)]
+
+            key = '{0}/{1}.pdf'.format(election, '_'.join(hierarchy))
+
+            s3.put_object(Key=key,
+                          Body=body,
+                          Metadata={
+                              'hierarchy': json.dumps(hierarchy),
+                              'election_name': election,
+                              'election_slug': election,
+                              'image_id': str(uuid4()),
+                          })
+
+
+def fillDrive(drive, folder_name, groups, pages, depth, branching, image_size):
+    '''
+    Add a folder of scans to the fake Drive, pages images to a group. Each
+    image differs by a pixel so none of them are duplicates of another.
+    '''
+
+    from PIL import Image as PILImage
+
+    folder_id = drive.addFolder(folder_name)
+
+    for index in range(groups):
+        group_name = '_'.join(hierarchyFor(index, depth, branching) + [str(index)])
+
+        for page in range(pages):
+            scan = PILImage.new('RGB', image_size, 'white')
+            scan.putpixel((index % image_size[0], page % image_size[1]), (0, 0, 0))
+
+            buf = BytesIO()
+            scan.save(buf, 'JPEG', quality=85)
+
+            drive.addFile(folder_id, '{0}_{1}.jpg'.format(group_name, page), buf.getvalue())
+
+    drive.sortChildren()
+
+
+def prepareDatabase(engine):
+    from transcriber.database import db
+    from transcriber.models import Image, ImageObject, ImageSyncCheckpoint, \
+        ImageTaskAssignment, FormMeta, TaskGroup
+
+    tables = [
+        TaskGroup.__table__,
+        FormMeta.__table__,
+        Image.__table__,
+        ImageObject.__table__,
+        ImageSyncCheckpoint.__table__,
+        ImageTaskAssignment.__table__,
+    ]
+
+    db.Model.metadata.create_all(engine, tables=tables)
+
+    with engine.begin() as conn:
+
+        # Made by a migration rather than the model
+        conn.execute(sa.text('''
+            DO $$
+            BEGIN
+              ALTER TABLE image_task_assignment
+                ADD CONSTRAINT image_to_form UNIQUE (image_id, form_id);
+            EXCEPTION WHEN duplicate_table OR duplicate_object THEN
+              NULL;
+            END $$
+        '''))
+
+        conn.execute(sa.text('''
+            DELETE FROM image_task_assignment
+            WHERE form_id IN (
+              SELECT id FROM form_meta WHERE election_name LIKE 'bench-%'
+            )
+        '''))
+        conn.execute(sa.text("DELETE FROM form_meta WHERE election_name LIKE 'bench-%'"))
+        conn.execute(sa.text("DELETE FROM image_object WHERE election_name LIKE 'bench-%'"))
+        conn.execute(sa.text("DELETE FROM image_sync_checkpoint WHERE range_key LIKE 'bench-%'"))
+        conn.execute(sa.text("DELETE FROM image WHERE election_name LIKE 'bench-%'"))
+
+
+def addForms(engine, elections):
+    '''
+    A form for each election, with every other one filtered down to the
+    first branch of the hierarchy.
+    '''
+
+    insert = '''
+        INSERT INTO form_meta (name, election_name, hierarchy_filter)
+        VALUES (:name, :election_name, :hierarchy_filter)
+    '''
+
+    forms = []
+
+    for index, election in enumerate(elections):
+        hierarchy_filter = None
+
+        if index % 2:
+            hierarchy_filter = [['l0-0']]
+
+        forms.append({
+            'name': election,
+            'election_name': election,
+            'hierarchy_filter': hierarchy_filter,
+        })
+
+    with engine.begin() as conn:
+        conn.execute(sa.text(insert), *forms)
+
+
+class Pipeline(object):
+    '''
+    Adds up the time spent in each stage of a pipeline and how much went
+    through it. The stages run at the same time on different threads so
+    the seconds are busy time summed over every call, which can come to
+    more than the time the whole run took.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.order = []
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    def record(self, name, seconds, items):
+        with self.lock:
+            if name not in self.order:
+                self.order.append(name)
+
+            stage = self.stages.setdefault(name, {'calls': 0, 'items': 0, 'seconds': 0})
+            stage['calls'] += 1
+            stage['items'] += items
+            stage['seconds'] += seconds
+
+    def wrap(self, name, func, items=lambda args, kwargs: 1, result_items=None):
+        '''
+        func, timed as the named stage. items counts what a call was given
+        before it runs, result_items counts what it returned instead.
+        '''
+
+        def timed(*args, **kwargs):
+            count = 0 if result_items else items(args, kwargs)
+
+            start = time.time()
+            result = func(*args, **kwargs)
+            elapsed = time.time() - start
+
+            if result_items:
+                count = result_items(result)
+
+            self.record(name, elapsed, count)
+
+            return result
+
+        return timed
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(self.stages[name], stage=name)
+                    for name in self.order if name in self.stages]
+
+
+def childPeak():
+    '''
+    Bytes used at most by any child process that has finished so far.
+    Conversion happens in a pool of processes that tracemalloc can't see
+    into, and this is the only way to get at their memory.
+    '''
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    # Kilobytes on Linux and bytes on macOS
+    if sys.platform == 'darwin':
+        return peak
+
+    return peak * 1024
+
+
+class Stages(object):
+    '''
+    Times each stage of a run and keeps track of how much it got through
+    and the most memory it had allocated at once, along with the most any
+    child process used. Runs given a Pipeline also get a breakdown of the
+    time spent in each step of the pipeline.
+    '''
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = []
+
+        if trace_memory:
+            tracemalloc.start()
+
+    def run(self, name, func, keys=lambda result: 0, rows=lambda result: 0, pipeline=None):
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.clear_traces()
+
+        if pipeline:
+            pipeline.reset()
+
+        print('\n== {} =='.format(name))
+
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+
+        peak = None
+        if self.trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+
+        self.results.append({
+            'stage': name,
+            'seconds': elapsed,
+            'keys': keys(result),
+            'rows': rows(result),
+            'peak': peak,
+            'child_peak': childPeak(),
+            'pipeline': pipeline.snapshot() if pipeline else [],
+        })
+
+        return result
+
+    def report(self):
+        header = '{0:<28} {1:>9} {2:>9} {3:>10} {4:>9} {5:>10} {6:>10} {7:>13}'
+
+        print()
+        print(header.format('stage', 'seconds', 'keys', 'keys/s', 'rows', 'rows/s',
+                            'peak MB', 'child peak MB'))
+
+        for result in self.results:
+            seconds = max(result['seconds'], 1e-9)
+            peak = '-'
+            child_peak = '-'
+
+            if result['peak'] is not None:
+                peak = '{:.1f}'.format(result['peak'] / 1024 / 1024)
+
+            if result['child_peak']:
+                child_peak = '{:.1f}'.format(result['child_peak'] / 1024 / 1024)
+
+            print(header.format(result['stage'],
+                                '{:.2f}'.format(result['seconds']),
+                                result['keys'],
+                                '{:.0f}'.format(result['keys'] / seconds),
+                                result['rows'],
+                                '{:.0f}'.format(result['rows'] / seconds),
+                                peak,
+                                child_peak))
+
+        steps = '{0:<28} {1:<10} {2:>9} {3:>9} {4:>12} {5:>10} {6:>12}'
+
+        print()
+        print(steps.format('stage', 'step', 'calls', 'items', 'busy seconds',
+                           'ms/call', 'items/busy s'))
+
+        for result in self.results:
+            for step in result['pipeline']:
+                busy = max(step['seconds'], 1e-9)
+
+                print(steps.format(result['stage'],
+                                   step['stage'],
+                                   step['calls'],
+                                   step['items'],
+                                   '{:.2f}'.format(step['seconds']),
+                                   '{:.1f}'.format(1000 * step['seconds'] / max(step['calls'], 1)),
+                                   '{:.0f}'.format(step['items'] / busy)))
+
+
+def benchmarkS3(args, stages, engine):
+    import transcriber.tasks as tasks
+    from transcriber.tasks import ImageUpdater, seed_image_tasks
+
+    # Everything in transcriber.tasks goes through this module level engine
+    tasks.engine = engine
+
+    elections = ['bench-{}'.format(i) for i in range(args.elections)]
+
+    s3 = FakeS3(latency=args.s3_latency / 1000)
+    fillBucket(s3, elections, args.keys, args.depth, args.branching)
+    addForms(engine, elections)
+
+    scratch = tempfile.mkdtemp(prefix='bench-manifest-')
+
+    try:
+        updater = ImageUpdater(client=s3,
+                               concurrency=args.concurrency,
+                               batch_size=args.batch_size,
+                               manifest_path=os.path.join(scratch, 'manifest.sqlite'))
+
+        pipeline = Pipeline()
+
+        listed = lambda page: len(page.get('Contents', [])) + len(page.get('CommonPrefixes', []))
+
+        s3.list_objects_v2 = pipeline.wrap('list',
+                                           s3.list_objects_v2,
+                                           result_items=listed)
+        updater.fetchMetadata = pipeline.wrap('metadata',
+                                              updater.fetchMetadata,
+                                              items=lambda args, kwargs: len(args[0]))
+        updater.flushStaged = pipeline.wrap('upsert',
+                                            updater.flushStaged,
+                                            items=lambda args, kwargs: len(args[0]))
+
+        total_keys = args.elections * args.keys
+
+        stages.run('s3 discover elections',
+                   updater.listElections,
+                   keys=len,
+                   pipeline=pipeline)
+
+        changed = lambda report: report['added'] + report['changed'] + report['removed']
+
+        stages.run('s3 refresh (cold)',
+                   lambda: updater.updateElections(elections, parallelism=args.parallelism),
+                   keys=lambda report: total_keys,
+                   rows=changed,
+                   pipeline=pipeline)
+
+        stages.run('s3 seed assignments',
+                   seed_image_tasks,
+                   rows=lambda created: sum(created.values()))
+
+        stages.run('s3 refresh (unchanged)',
+                   lambda: updater.updateElections(elections, parallelism=args.parallelism),
+                   keys=lambda report: total_keys,
+                   rows=changed,
+                   pipeline=pipeline)
+
+        # Replace a tenth of the keys and drop another tenth
+        for election in elections:
+            for index in range(0, args.keys, 10):
+                key = s3.keys[bisect.bisect_left(s3.keys, election + '/') + index]
+                s3.put_object(Key=key,
+                              Body=b'%PDF-1.3 changed',
+                              Metadata=s3.objects[key]['Metadata'])
+
+        for key in list(s3.keys[5::10]):
+            del s3.objects[key]
+            s3.keys.remove(key)
+
+        stages.run('s3 refresh (20% churn)',
+                   lambda: updater.updateElections(elections, parallelism=args.parallelism),
+                   keys=lambda report: len(s3.keys),
+                   rows=changed,
+                   pipeline=pipeline)
+
+        print('\n{} S3 requests'.format(s3.requests))
+
+    finally:
+        shutil.rmtree(scratch)
+
+
+def benchmarkDrive(args, stages, engine):
+    import syncDriveFolder
+    from syncDriveFolder import SyncGoogle
+
+    drive = FakeDrive(latency=args.drive_latency / 1000)
+    fillDrive(drive,
+              'bench-drive',
+              args.groups,
+              args.pages,
+              args.depth,
+              args.branching,
+              (args.image_width, args.image_height))
+
+    s3 = FakeS3(latency=args.s3_latency / 1000)
+
+    scratch = tempfile.mkdtemp(prefix='bench-drive-')
+
+    image_rows = '''
+        SELECT COUNT(*) FROM image WHERE election_name = 'bench-drive'
+    '''
+
+    try:
+        syncer = SyncGoogle(election_name='bench-drive',
+                            drive_folder='bench-drive',
+                            capture_hierarchy=True,
+                            service=drive,
+                            s3_client=s3,
+                            work_dir=scratch,
+                            db_conn=args.db_conn,
+                            convert_parallelism=0 if args.convert_in_process else None)
+
+        pipeline = Pipeline()
+
+        syncer.downloadImage = pipeline.wrap('download', syncer.downloadImage)
+        s3.upload_fileobj = pipeline.wrap('upload', s3.upload_fileobj)
+        syncer.saveImages = pipeline.wrap('save rows',
+                                          syncer.saveImages,
+                                          items=lambda args, kwargs: len(args[0]))
+
+        # Conversions in the process pool can't be timed from here, only
+        # the ones run in this process
+        convert_images = syncDriveFolder.convertImages
+
+        if args.convert_in_process:
+            syncDriveFolder.convertImages = pipeline.wrap('convert',
+                                                          convert_images,
+                                                          items=lambda args, kwargs: len(args[0]))
+
+        try:
+            stages.run('drive sync',
+                       syncer.sync,
+                       keys=lambda result: len(drive.drive_files),
+                       rows=lambda result: engine.execute(sa.text(image_rows)).scalar(),
+                       pipeline=pipeline)
+        finally:
+            syncDriveFolder.convertImages = convert_images
+
+        print('\n{0} Drive requests, {1} S3 requests, {2:.1f} MB of PDFs'
+              .format(drive.requests,
+                      s3.requests,
+                      sum(o['Size'] for o in s3.objects.values()) / 1024 / 1024))
+
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark image ingest against fake S3 and Google Drive',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--db-conn', type=str, required=True,
+                        help='SQLAlchemy URL of a scratch Postgres database to write to')
+    parser.add_argument('--only', choices=['s3', 'drive'],
+                        help='Only run one of the benchmarks')
+    parser.add_argument('--elections', type=int, default=4,
+                        help='Elections in the fake S3 bucket')
+    parser.add_argument('--keys', type=int, default=5000,
+                        help='Keys in each election')
+    parser.add_argument('--groups', type=int, default=200,
+                        help='Documents in the fake Drive folder')
+    parser.add_argument('--pages', type=int, default=2,
+                        help='Images in each document')
+    parser.add_argument('--image-width', type=int, default=1200)
+    parser.add_argument('--image-height', type=int, default=1600)
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Levels of hierarchy in the generated names')
+    parser.add_argument('--branching', type=int, default=10,
+                        help='Choices at each level of the hierarchy')
+    parser.add_argument('--s3-latency', type=float, default=20,
+                        help='Milliseconds added to each S3 request')
+    parser.add_argument('--drive-latency', type=float, default=50,
+                        help='Milliseconds added to each Drive request')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='S3 metadata requests to make at once')
+    parser.add_argument('--parallelism', type=int, default=4,
+                        help='Elections to refresh at once')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='Keys per database batch when refreshing')
+    parser.add_argument('--convert-in-process', action='store_true',
+                        help='Convert images to PDFs in this process rather than a pool of processes, '
+                             'so that conversion gets timed and its memory traced along with everything else')
+    parser.add_argument('--no-memory', action='store_true',
+                        help="Don't trace memory use. Tracing slows things down a fair bit")
+
+    args = parser.parse_args()
+
+    engine = sa.create_engine(args.db_conn)
+    prepareDatabase(engine)
+
+    stages = Stages(trace_memory=not args.no_memory)
+
+    if args.only in (None, 's3'):
+        benchmarkS3(args, stages, engine)
+
+    if args.only in (None, 'drive'):
+        benchmarkDrive(args, stages, engine)
+
+    stages.report()
@@ -1,4 +1,30 @@
 if __name__ == "__main__":
-    
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the delayed work queue',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=1,
+                        help='Number of jobs to run concurrently')
+    parser.add_argument('--worker-type',
+                        choices=['thread', 'process'],
+                        default='thread',
+                        help='Run jobs in threads or, for CPU heavy jobs, in child processes')
+    parser.add_argument('-b', '--batch-size',
+                        type=int,
+                        default=1,
+                        help='Number of waiting jobs each worker claims at a time')
+    parser.add_argument('-l', '--lanes',
+                        type=str,
+                        default=None,
+                        help='Comma separated list of lanes to take jobs from. Defaults to every lane')
+
+    args = parser.parse_args()
+
     from transcriber.queue import queue_daemon
-    queue_daemon()
+    queue_daemon(worker_count=args.workers,
+                 worker_type=args.worker_type,
+                 batch_size=args.batch_size,
+                 lanes=args.lanes.split(',') if args.lanes else None)
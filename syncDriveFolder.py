@@ -3,7 +3,14 @@ from io import BytesIO
 import json
 import csv
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
 import itertools
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 
 import httplib2
 
@@ -15,11 +22,11 @@ from apiclient.http import MediaIoBaseDownload
 from apiclient.errors import HttpError
 
 import boto3
-import botocore
+from boto3.s3.transfer import TransferConfig
 
 import img2pdf
 
-from PIL import ImageFile
+from PIL import Image, ImageFile, ImageOps
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 
@@ -28,22 +35,420 @@ from transcriber.helpers import slugify
 
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 
+# Drive answers with these when we're going too fast or it's having a bad
+# time. Anything else isn't going to get better by trying again.
+RETRY_STATUSES = set([403, 429, 500, 502, 503, 504])
+
+# What we need to know about each file when listing a folder
+LIST_FIELDS = 'nextPageToken, files(id, name, mimeType, md5Checksum, size)'
+
+# Normalized images are scaled so their long side is at most this many
+# inches at the target DPI, the long side of a letter page
+PAGE_INCHES = 11
+
+def normalizeImage(image, target_dpi, jpeg_quality):
+    '''
+    Turn a scan the right way up according to its EXIF orientation,
+    scale it down to target_dpi on a letter page and save it again as a
+    JPEG. The image is left as it was if it can't be read or if none of
+    that makes it any smaller.
+    '''
+
+    try:
+        original = Image.open(BytesIO(image))
+
+        # 0x0112 is the EXIF orientation tag, 1 means the right way up
+        rotated = original.getexif().get(0x0112, 1) != 1
+
+        normalized = ImageOps.exif_transpose(original)
+
+        longest = PAGE_INCHES * target_dpi
+        resized = max(normalized.size) > longest
+
+        if resized:
+            normalized.thumbnail((longest, longest), Image.LANCZOS)
+
+        if normalized.mode not in ('RGB', 'L'):
+            normalized = normalized.convert('RGB')
+
+        out = BytesIO()
+        normalized.save(out,
+                        format='JPEG',
+                        quality=jpeg_quality,
+                        optimize=True,
+                        dpi=(target_dpi, target_dpi))
+
+    except (OSError, ValueError, SyntaxError):
+        return image
+
+    if len(out.getvalue()) >= len(image) and not rotated:
+        return image
+
+    return out.getvalue()
+
+def convertImages(images,
+                  spool_size=None,
+                  spool_dir=None,
+                  target_dpi=None,
+                  jpeg_quality=75):
+    '''
+    Turn a group of downloaded images, as bytes, into a PDF. This runs in
+    the conversion processes so it returns what happened rather than
+    raising. A PDF bigger than spool_size is written to a file in
+    spool_dir and the path to that is returned instead of the PDF so it
+    doesn't have to come back through the pipe. With a target_dpi each
+    image is normalized first, and the number of bytes going into the
+    PDF before and after that comes back as well.
+    '''
+
+    # Some of the images never arrived
+    if any(image is None for image in images):
+        return 'incomplete', images, None
+
+    normalized = None
+
+    if target_dpi:
+        before = sum(len(image) for image in images)
+
+        images = [normalizeImage(image, target_dpi, jpeg_quality)
+                  for image in images]
+
+        normalized = (before, sum(len(image) for image in images))
+
+    try:
+        body = img2pdf.convert(images)
+    except (img2pdf.ImageOpenError, OSError, ZeroDivisionError, TypeError) as e:
+        return 'failed', str(e), normalized
+
+    if spool_size and len(body) > spool_size:
+        with tempfile.NamedTemporaryFile(dir=spool_dir, suffix='.pdf', delete=False) as f:
+            f.write(body)
+
+        return 'spooled', f.name, normalized
+
+    return 'converted', body, normalized
+
+class DownloadLedger(object):
+    '''
+    Remembers which Drive files have been synced, in a SQLite file.
+    Files are known by their Drive id and by their checksum and size as
+    well as their name so that a file which has been renamed, or uploaded
+    again under a new name, isn't fetched a second time. Everything is
+    also kept in memory for quick lookups.
+    '''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS downloads (
+                  id INTEGER PRIMARY KEY,
+                  file_id TEXT UNIQUE,
+                  title TEXT,
+                  md5 TEXT,
+                  size INTEGER,
+                  downloaded TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            self.conn.execute('''
+                CREATE INDEX IF NOT EXISTS downloads_content_idx
+                ON downloads (md5, size)
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS ledger_imports (
+                  path TEXT PRIMARY KEY,
+                  imported INTEGER NOT NULL
+                )
+            ''')
+
+            # Where each folder's listing had got to, the files listed so
+            # far and the groups that have been uploaded, so that a sync
+            # started with --resume can pick up where the last one stopped
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS folder_checkpoints (
+                  folder_id TEXT PRIMARY KEY,
+                  page_token TEXT,
+                  listed INTEGER NOT NULL DEFAULT 0,
+                  finished INTEGER NOT NULL DEFAULT 0,
+                  updated TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS checkpoint_files (
+                  id INTEGER PRIMARY KEY,
+                  folder_id TEXT NOT NULL,
+                  file_id TEXT,
+                  title TEXT,
+                  md5 TEXT,
+                  size INTEGER
+                )
+            ''')
+            self.conn.execute('''
+                CREATE INDEX IF NOT EXISTS checkpoint_files_folder_idx
+                ON checkpoint_files (folder_id)
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS completed_groups (
+                  folder_id TEXT NOT NULL,
+                  group_name TEXT NOT NULL,
+                  PRIMARY KEY (folder_id, group_name)
+                )
+            ''')
+
+        self.file_ids = set()
+        self.titles = set()
+        self.contents = set()
+
+        for file_id, title, md5, size in self.conn.execute('''
+            SELECT file_id, title, md5, size FROM downloads
+        '''):
+            self.remember(file_id, title, md5, size)
+
+    def remember(self, file_id, title, md5, size):
+        if file_id:
+            self.file_ids.add(file_id)
+
+        if title:
+            self.titles.add(title)
+
+        if md5:
+            self.contents.add((md5, size))
+
+    def contains(self, file_id=None, title=None, md5=None, size=None):
+        return file_id in self.file_ids \
+            or (md5 is not None and (md5, size) in self.contents) \
+            or title in self.titles
+
+    def add(self, file_id=None, title=None, md5=None, size=None):
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute('''
+                    INSERT OR REPLACE INTO downloads (file_id, title, md5, size)
+                    VALUES (?, ?, ?, ?)
+                ''', (file_id, title, md5, size))
+
+            self.remember(file_id, title, md5, size)
+
+    def importJSON(self, path):
+        '''
+        Bring in the list of names that downloaded_images.json used to
+        keep. This only happens once, after that the file is left alone.
+        '''
+
+        path = os.path.abspath(path)
+
+        already = self.conn.execute('SELECT 1 FROM ledger_imports WHERE path = ?',
+                                    (path,)).fetchone()
+
+        if already or not os.path.exists(path):
+            return 0
+
+        with open(path) as f:
+            titles = [t for t in set(json.load(f)) if t not in self.titles]
+
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('INSERT INTO downloads (title) VALUES (?)',
+                                      [(title,) for title in titles])
+
+                self.conn.execute('INSERT INTO ledger_imports (path, imported) VALUES (?, ?)',
+                                  (path, len(titles)))
+
+            for title in titles:
+                self.remember(None, title, None, None)
+
+        return len(titles)
+
+    def checkpoint(self, folder_id):
+        '''
+        Where the listing of a folder had got to as (page token, listed,
+        finished), or None if there's no checkpoint for it.
+        '''
+
+        with self.lock:
+            return self.conn.execute('''
+                SELECT page_token, listed, finished
+                FROM folder_checkpoints
+                WHERE folder_id = ?
+            ''', (folder_id,)).fetchone()
+
+    def checkpointFiles(self, folder_id):
+
+        with self.lock:
+            return self.conn.execute('''
+                SELECT file_id, title, md5, size
+                FROM checkpoint_files
+                WHERE folder_id = ?
+                ORDER BY id
+            ''', (folder_id,)).fetchall()
+
+    def savePage(self, folder_id, drive_files, page_token):
+        '''
+        Record a page of a folder's listing along with the token for the
+        next one. The files and the token go in together so a checkpoint
+        never points past files it doesn't have.
+        '''
+
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('''
+                    INSERT INTO checkpoint_files (folder_id, file_id, title, md5, size)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(folder_id,) + tuple(drive_file) for drive_file in drive_files])
+
+                self.conn.execute('''
+                    INSERT OR REPLACE INTO folder_checkpoints
+                      (folder_id, page_token, listed, finished, updated)
+                    VALUES (?, ?, ?, 0, CURRENT_TIMESTAMP)
+                ''', (folder_id, page_token, page_token is None))
+
+    def completedGroups(self, folder_id):
+
+        with self.lock:
+            rows = self.conn.execute('''
+                SELECT group_name FROM completed_groups WHERE folder_id = ?
+            ''', (folder_id,))
+
+            return set(group_name for group_name, in rows)
+
+    def completeGroup(self, folder_id, group_name):
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute('''
+                    INSERT OR IGNORE INTO completed_groups (folder_id, group_name)
+                    VALUES (?, ?)
+                ''', (folder_id, group_name))
+
+    def finishFolder(self, folder_id):
+        '''
+        Every group in the folder made it to S3. Only the fact that it's
+        done needs keeping after this.
+        '''
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute('''
+                    UPDATE folder_checkpoints
+                    SET finished = 1, updated = CURRENT_TIMESTAMP
+                    WHERE folder_id = ?
+                ''', (folder_id,))
+
+                self.conn.execute('DELETE FROM checkpoint_files WHERE folder_id = ?',
+                                  (folder_id,))
+                self.conn.execute('DELETE FROM completed_groups WHERE folder_id = ?',
+                                  (folder_id,))
+
+    def clearCheckpoint(self, folder_id):
+
+        with self.lock:
+            with self.conn:
+                for table in ('folder_checkpoints', 'checkpoint_files', 'completed_groups'):
+                    self.conn.execute('DELETE FROM {} WHERE folder_id = ?'.format(table),
+                                      (folder_id,))
+
 class SyncGoogle(object):
     def __init__(self,
                  election_name=None,
                  drive_folder=None,
                  aws_creds=None,
                  google_creds=None,
-                 capture_hierarchy=False):
-
-        self.this_dir = os.path.abspath(os.path.dirname(__file__))
+                 capture_hierarchy=False,
+                 service=None,
+                 s3_client=None,
+                 work_dir=None,
+                 db_conn=DB_CONN,
+                 download_parallelism=4,
+                 download_retries=5,
+                 retry_backoff=1,
+                 convert_parallelism=None,
+                 upload_parallelism=4,
+                 queue_size=8,
+                 image_batch_size=100,
+                 image_flush_interval=30,
+                 spool_size=8 * 1024 * 1024,
+                 buffer_memory=256 * 1024 * 1024,
+                 resume=False,
+                 target_dpi=None,
+                 jpeg_quality=75):
+
+        self.this_dir = work_dir or os.path.abspath(os.path.dirname(__file__))
         self.capture_hierarchy = capture_hierarchy
-
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(google_creds,
-                                                                       SCOPES)
-        http = credentials.authorize(httplib2.Http())
-
-        self.service = build('drive', 'v3', http=http)
+        self.engine = sa.create_engine(db_conn)
+        self.download_parallelism = download_parallelism
+        self.download_retries = download_retries
+        self.retry_backoff = retry_backoff
+        # 0 converts on a single thread in this process rather than in a
+        # pool of processes, which is slower but easier to profile
+        if convert_parallelism is None:
+            convert_parallelism = os.cpu_count() or 1
+
+        self.convert_parallelism = convert_parallelism
+        self.upload_parallelism = upload_parallelism
+        self.queue_size = max(queue_size, 1)
+
+        # Images are saved to the database in batches of image_batch_size,
+        # or whatever has built up every image_flush_interval seconds
+        self.image_batch_size = image_batch_size
+        self.image_flush_interval = image_flush_interval
+        self.pending_images = []
+        self.pending_groups = []
+        self.pending_lock = threading.Lock()
+
+        # Held for the whole of a flush so that one flush can't finish, and
+        # a folder be marked done, while another is still writing rows
+        self.flush_lock = threading.Lock()
+        self.last_flush = time.time()
+
+        # Downloads are kept in memory until their group is converted.
+        # Any one bigger than spool_size, or that would take the total
+        # past buffer_memory, is written to a file in this_dir instead and
+        # only its path is kept, so a big folder doesn't hold a file open
+        # for every image in it.
+        self.spool_size = spool_size
+        self.buffer_memory = buffer_memory
+        self.buffers = {}
+        self.buffers_lock = threading.Lock()
+        self.buffered_bytes = 0
+        self.already_synced = set()
+
+        # With resume, folders carry on from their checkpoints in the
+        # ledger rather than being listed again from the start
+        self.resume = resume
+        self.listed_folders = set()
+
+        # With a target_dpi images are rotated, scaled and recompressed
+        # before they go into their PDF. The bytes that went in and came
+        # out are totted up in normalized_bytes for the report at the end.
+        self.target_dpi = target_dpi
+        self.jpeg_quality = jpeg_quality
+        self.normalized_bytes = [0, 0]
+        self.normalized_lock = threading.Lock()
+
+        # PDFs bigger than spool_size are uploaded in parts
+        self.transfer_config = TransferConfig(multipart_threshold=spool_size,
+                                              multipart_chunksize=spool_size)
+
+        # httplib2 isn't thread safe so each download thread gets its own
+        # authorized http and service, made by threadService
+        self.credentials = None
+        self.local = threading.local()
+
+        if service is None:
+            self.credentials = ServiceAccountCredentials.from_json_keyfile_name(google_creds,
+                                                                                SCOPES)
+            http = self.credentials.authorize(httplib2.Http())
+
+            service = build('drive', 'v3', http=http)
+
+        self.service = service
+        self.local.service = service
 
         result = self.service.files().list(q="name contains '{}'".format(drive_folder)).execute()
 
@@ -54,13 +459,22 @@ class SyncGoogle(object):
         self.election_name = election_name
         self.election_slug = slugify(election_name)
 
-        aws_key, aws_secret_key = self.awsCredentials(aws_creds)
+        if s3_client is None:
+            aws_key, aws_secret_key = self.awsCredentials(aws_creds)
 
-        self.s3_client = boto3.client('s3',
-                                      aws_access_key_id=aws_key,
-                                      aws_secret_access_key=aws_secret_key)
+            s3_client = boto3.client('s3',
+                                     aws_access_key_id=aws_key,
+                                     aws_secret_access_key=aws_secret_key)
 
-        self.downloaded_images = self.downloadedImages()
+        self.s3_client = s3_client
+
+        self.ledger = DownloadLedger(os.path.join(self.this_dir, 'download_ledger.sqlite'))
+
+        imported = self.ledger.importJSON(os.path.join(self.this_dir,
+                                                       'downloaded_images.json'))
+
+        if imported:
+            print('imported {} downloaded images into the ledger'.format(imported))
 
     def awsCredentials(self, creds_path):
 
@@ -74,28 +488,31 @@ class SyncGoogle(object):
         return aws_key, aws_secret_key
 
 
-    def downloadedImages(self):
+    def threadService(self):
+
+        # Injected services (the benchmark's fake Drive) are shared
+        if self.credentials is None:
+            return self.service
 
-        downloaded_path = os.path.join(self.this_dir, 'downloaded_images.json')
+        service = getattr(self.local, 'service', None)
 
-        if not os.path.exists(downloaded_path):
-            with open(downloaded_path, 'w') as f:
-                json.dump([], f)
+        if service is None:
+            http = self.credentials.authorize(httplib2.Http())
+            service = build('drive', 'v3', http=http)
 
-        with open(downloaded_path) as f:
-            return json.load(f)
+            self.local.service = service
 
-    def addDownloadedImage(self, title):
+        return service
 
-        self.downloaded_images.append(title)
+    def downloadImage(self, file_id, title, md5=None, size=None):
 
-        with open(os.path.join(self.this_dir, 'downloaded_images.json'), 'w') as f:
-            json.dump(self.downloaded_images, f)
+        service = self.threadService()
 
-    def downloadImage(self, file_id, title):
-        contents = self.service.files().get_media(fileId=file_id)
+        for attempt in range(self.download_retries + 1):
+            contents = service.files().get_media(fileId=file_id)
 
-        with open(os.path.join(self.this_dir, title), 'wb') as fd:
+            fd = tempfile.SpooledTemporaryFile(max_size=self.spool_size,
+                                               dir=self.this_dir)
             media = MediaIoBaseDownload(fd, contents)
             done = False
 
@@ -103,82 +520,282 @@ class SyncGoogle(object):
 
                 try:
                     status, done = media.next_chunk()
-                except HttpError:
-                    print('Could not get file {1} ({0})'.format(file_id, title))
+                except HttpError as e:
+                    fd.close()
+
+                    if e.resp.status not in RETRY_STATUSES \
+                            or attempt == self.download_retries:
+                        print('Could not get file {1} ({0})'.format(file_id, title))
+                        return
+
                     break
-        if done:
 
-            self.addDownloadedImage(title)
+            if done:
+                self.keepImage(title, fd, (file_id, md5, size))
+                return
+
+            time.sleep(self.retry_backoff * 2 ** attempt)
+
+    def keepImage(self, title, fd, drive_file):
+
+        downloaded = fd.tell()
+        in_memory = 0
+
+        with self.buffers_lock:
+            if downloaded <= self.spool_size \
+                    and self.buffered_bytes + downloaded <= self.buffer_memory:
+                in_memory = downloaded
+                self.buffered_bytes += in_memory
+
+        fd.seek(0)
+
+        if in_memory:
+            contents = fd.read()
+        else:
+            with tempfile.NamedTemporaryFile(dir=self.this_dir,
+                                             suffix='.download',
+                                             delete=False) as f:
+                shutil.copyfileobj(fd, f)
+
+            contents = f.name
+
+        fd.close()
+
+        with self.buffers_lock:
+            previous = self.buffers.pop(title, None)
+            self.buffers[title] = (contents, in_memory, drive_file)
+
+        if previous:
+            self.releaseImage(previous)
+
+    def takeImage(self, title):
+        '''
+        The contents of a downloaded image along with the (file id, md5,
+        size) it came from, or (None, None) if we don't have it.
+        '''
+
+        with self.buffers_lock:
+            buffered = self.buffers.pop(title, None)
+
+        if buffered is None:
+            return None, None
+
+        contents, in_memory, drive_file = buffered
+
+        if in_memory:
+            image = contents
+        else:
+            with open(contents, 'rb') as f:
+                image = f.read()
+
+        self.releaseImage(buffered)
+
+        return image, drive_file
+
+    def releaseImage(self, buffered):
+        contents, in_memory, _ = buffered
+
+        if in_memory:
+            with self.buffers_lock:
+                self.buffered_bytes -= in_memory
+        else:
+            os.remove(contents)
+
+    def releaseAll(self):
+
+        with self.buffers_lock:
+            buffered = list(self.buffers.values())
+            self.buffers = {}
+
+        for each in buffered:
+            self.releaseImage(each)
 
     def iterFiles(self):
 
-        file_count = 0
+        executor = ThreadPoolExecutor(max_workers=max(self.download_parallelism, 1))
+
+        try:
+            for folder_id in self.folder_ids:
+                yield from self.iterFolder(folder_id, executor)
+        finally:
+            executor.shutdown()
+
+    def iterFolder(self, folder_id, executor):
+        '''
+        Download everything in a folder that we don't have yet, on the
+        download threads while the listing carries on, and then group the
+        files up by name the same way as ever once they've all arrived.
+
+        Each page of the listing is checkpointed in the ledger. When
+        resuming, a finished folder is skipped, the files from the pages
+        already listed are taken from the checkpoint, listing carries on
+        from the saved page token and groups already uploaded are left out.
+        '''
+
+        checkpoint = None
+
+        if self.resume:
+            checkpoint = self.ledger.checkpoint(folder_id)
+        else:
+            self.ledger.clearCheckpoint(folder_id)
+
+        all_files = []
+        downloads = []
+
+        def queueFiles(drive_files):
+            for file_id, title, md5, size in drive_files:
 
-        for folder_id in self.folder_ids:
+                if self.ledger.contains(file_id=file_id,
+                                        title=title,
+                                        md5=md5,
+                                        size=size):
 
-            page_token = None
+                    self.already_synced.add(title)
 
-            params = {
-                'q': "'{}' in parents".format(folder_id),
-                'orderBy': 'name',
-            }
+                elif title not in self.buffers:
 
-            all_files = []
+                    downloads.append(executor.submit(self.downloadImage,
+                                                     file_id,
+                                                     title,
+                                                     md5=md5,
+                                                     size=size))
 
-            while True:
+                all_files.append(title)
 
-                if page_token:
-                    params['pageToken'] = page_token
+        page_token = None
+        listed = False
 
+        if checkpoint:
+            page_token, listed, finished = checkpoint
+
+            if finished:
+                print('Skipping folder {}, it has already been synced'.format(folder_id))
+                self.listed_folders.add(folder_id)
+                return
+
+            queueFiles(self.ledger.checkpointFiles(folder_id))
+
+        params = {
+            'q': "'{}' in parents".format(folder_id),
+            'orderBy': 'name',
+            'fields': LIST_FIELDS,
+        }
+
+        while not listed:
+
+            if page_token:
+                params['pageToken'] = page_token
+
+            try:
                 folder_files = self.service.files().list(**params).execute()
+            except HttpError as e:
+
+                # Page tokens don't last forever. If the one we saved has
+                # gone stale start listing the folder again, the ledger
+                # still knows which files have been synced.
+                if e.resp.status != 400 or not checkpoint or not page_token:
+                    raise
 
-                page_token = folder_files.get('nextPageToken')
+                print('Checkpoint for folder {} has expired, listing it again'.format(folder_id))
 
-                inserts = []
+                self.ledger.clearCheckpoint(folder_id)
+                checkpoint = None
+                page_token = None
+                params.pop('pageToken', None)
+                del all_files[:]
 
-                for folder_file in folder_files['files']:
+                continue
 
-                    title = folder_file['name']
-                    file_id = folder_file['id']
+            page_token = folder_files.get('nextPageToken')
 
-                    if title not in self.downloaded_images:
+            drive_files = []
 
-                        self.downloadImage(file_id, title)
+            for folder_file in folder_files['files']:
+                size = folder_file.get('size')
 
-                    all_files.append(title)
+                drive_files.append((folder_file['id'],
+                                    folder_file['name'],
+                                    folder_file.get('md5Checksum'),
+                                    int(size) if size is not None else None))
 
-                if not page_token:
-                    break
+            self.ledger.savePage(folder_id, drive_files, page_token)
 
-            grouper = lambda x: x.rsplit('_', 1)[0]
+            queueFiles(drive_files)
 
-            all_files_sorted = sorted(all_files, key=grouper)
+            listed = page_token is None
 
-            yield from itertools.groupby(all_files_sorted, key=grouper)
+        for download in downloads:
+            download.result()
 
-    def saveImage(self, key):
+        completed = self.ledger.completedGroups(folder_id)
 
-        try:
-            image = self.s3_client.head_object(Bucket=self.bucket, Key=key)['Metadata']
-        except botocore.exceptions.ClientError:
-            return
+        grouper = lambda x: x.rsplit('_', 1)[0]
+
+        all_files_sorted = sorted(all_files, key=grouper)
+
+        for group_name, file_group in itertools.groupby(all_files_sorted, key=grouper):
+
+            if group_name in completed:
+                self.already_synced.update(file_group)
+                continue
+
+            yield folder_id, group_name, file_group
+
+        self.listed_folders.add(folder_id)
+
+    def saveImage(self, key, metadata, hierarchy, group=None):
 
         fetch_url_fmt = 'https://s3.amazonaws.com/{bucket}/{key}'
 
         fetch_url = fetch_url_fmt.format(bucket=self.bucket,
-                                            key=key)
+                                         key=key)
 
         values = dict(image_type='pdf',
-                        fetch_url=fetch_url,
-                        election_name=self.election_slug,
-                        id=image['image_id'],
-                        hierarchy=json.loads(image['hierarchy']),
-                        is_page_url=False,
-                        is_current=True)
+                      fetch_url=fetch_url,
+                      election_name=self.election_slug,
+                      id=metadata['image_id'],
+                      hierarchy=hierarchy,
+                      is_page_url=False,
+                      is_current=True)
+
+        with self.pending_lock:
+            self.pending_images.append(values)
+
+            if group:
+                self.pending_groups.append(group)
+
+            flush = len(self.pending_images) >= self.image_batch_size \
+                or time.time() - self.last_flush >= self.image_flush_interval
+
+        if flush:
+            self.flushImages()
+
+    def flushImages(self):
 
-        engine = sa.create_engine(DB_CONN)
+        with self.flush_lock:
+            with self.pending_lock:
+                images = self.pending_images
+                groups = self.pending_groups
+                self.pending_images = []
+                self.pending_groups = []
+                self.last_flush = time.time()
 
-        with engine.begin() as conn:
+            if not images:
+                return
+
+            try:
+                self.saveImages(images, groups)
+            except Exception:
+                # Put them back for the next flush to try again
+                with self.pending_lock:
+                    self.pending_images = images + self.pending_images
+                    self.pending_groups = groups + self.pending_groups
+
+                raise
+
+    def saveImages(self, images, groups):
+
+        with self.engine.begin() as conn:
             conn.execute(sa.text('''
                 INSERT INTO image (
                 id,
@@ -204,61 +821,222 @@ class SyncGoogle(object):
                 hierarchy = :hierarchy,
                 is_page_url = :is_page_url,
                 is_current = :is_current
-            '''), **values)
+            '''), *images)
+
+        # Only once the images are in the database do their files count
+        # as synced, so a sync that's killed part way through does them
+        # again rather than leaving them out
+        for folder_id, group_name, filenames, drive_files in groups:
 
-        del engine
+            for title, drive_file in zip(filenames, drive_files):
+                if drive_file:
+                    file_id, md5, size = drive_file
+                    self.ledger.add(file_id=file_id, title=title, md5=md5, size=size)
+
+            self.ledger.completeGroup(folder_id, group_name)
 
     def sync(self):
+        '''
+        Download, convert and upload every group of images. Conversion is
+        CPU bound so it happens in a pool of processes, and uploads happen
+        on a pool of threads. At most queue_size groups wait on each stage
+        so a slow stage holds up the ones ahead of it rather than letting
+        PDFs pile up in memory.
+        '''
 
-        for group_name, file_group in self.iterFiles():
+        if self.convert_parallelism:
+            conversions = ProcessPoolExecutor(max_workers=self.convert_parallelism)
+        else:
+            conversions = ThreadPoolExecutor(max_workers=1)
 
-            filenames = list(file_group)
+        uploads = ThreadPoolExecutor(max_workers=self.upload_parallelism)
 
-            if self.capture_hierarchy:
-                hierarchy = self.constructHierarchy(group_name)
-            else:
-                hierarchy = []
+        converting = deque()
+        uploading = deque()
 
-            metadata = {
-                'hierarchy': json.dumps(hierarchy),
-                'election_name': self.election_name,
-                'election_slug': self.election_slug,
-                'image_id': str(uuid4()),
-            }
+        # Groups of each folder still on their way to S3, and folders with
+        # a group that didn't make it. Those aren't marked finished so a
+        # resumed sync tries their groups again.
+        outstanding = {}
+        failed = set()
+        finished = set()
 
-            key = '{0}/{1}'.format(self.election_slug,
-                                   '{}.pdf'.format(group_name))
+        def finishUpload():
+            folder_id, upload = uploading.popleft()
 
-            try:
-                body = img2pdf.convert(filenames)
-            except (img2pdf.ImageOpenError, OSError, ZeroDivisionError) as e:
-                print("Couldn't convert: {0} ({1})".format(group_name, e))
-                continue
-            except TypeError:
-                for filename in filenames:
-                    file_blob = self.service.files().list(q="name = '{}'".format(filename)).execute()
+            if not upload.result():
+                failed.add(folder_id)
 
-                    if file_blob['files']:
-                        file_id = file_blob['files'][0]['id']
-                        self.downloadImage(file_id, filename)
+            outstanding[folder_id] -= 1
 
-                try:
-                    body = img2pdf.convert(filenames)
-                except (img2pdf.ImageOpenError, OSError, ZeroDivisionError) as e:
-                    print("Couldn't convert: {0} ({1})".format(group_name, e))
+        def finishFolders():
+            done = [folder_id for folder_id in self.listed_folders - finished - failed
+                    if not outstanding.get(folder_id)]
+
+            if not done:
+                return
+
+            self.flushImages()
+
+            for folder_id in done:
+                self.ledger.finishFolder(folder_id)
+                finished.add(folder_id)
+
+        def startUpload():
+            group, conversion = converting.popleft()
+            folder_id = group[0]
+
+            uploading.append((folder_id, uploads.submit(self.uploadGroup,
+                                                        group,
+                                                        conversion.result())))
+
+            if len(uploading) >= self.queue_size:
+                finishUpload()
+                finishFolders()
+
+        try:
+            for folder_id, group_name, file_group in self.iterFiles():
+
+                filenames = list(file_group)
+
+                if all(title in self.already_synced for title in filenames):
+                    continue
+
+                taken = [self.takeImage(title) for title in filenames]
+
+                images = [image for image, _ in taken]
+                drive_files = [drive_file for _, drive_file in taken]
+
+                outstanding[folder_id] = outstanding.get(folder_id, 0) + 1
+
+                converting.append(((folder_id, group_name, filenames, drive_files),
+                                   conversions.submit(convertImages,
+                                                      images,
+                                                      self.spool_size,
+                                                      self.this_dir,
+                                                      self.target_dpi,
+                                                      self.jpeg_quality)))
+
+                if len(converting) >= self.queue_size:
+                    startUpload()
+
+            while converting:
+                startUpload()
+
+            while uploading:
+                finishUpload()
+
+            finishFolders()
+
+        finally:
+            conversions.shutdown()
+            uploads.shutdown()
+
+            self.flushImages()
+
+            # Anything left over belongs to groups that never made it
+            self.releaseAll()
+
+            if self.target_dpi:
+                self.reportNormalized()
+
+    def reportNormalized(self):
+        before, after = self.normalized_bytes
+
+        if not before:
+            return
+
+        print('Normalized images from {0:.1f} MB to {1:.1f} MB, {2:.1f}% smaller'.format(
+            before / 1024 / 1024,
+            after / 1024 / 1024,
+            100 * (before - after) / before))
+
+    def uploadGroup(self, group, conversion):
+
+        folder_id, group_name, filenames, drive_files = group
+        status, body, normalized = conversion
+
+        if status == 'incomplete':
+            images = body
+            service = self.threadService()
+
+            for index, filename in enumerate(filenames):
+
+                if images[index] is not None:
                     continue
 
-            self.s3_client.put_object(ACL='public-read',
-                                      Body=body,
-                                      Bucket=self.bucket,
-                                      Key=key,
-                                      ContentType='application/pdf',
-                                      Metadata=metadata)
+                file_blob = service.files().list(q="name = '{}'".format(filename),
+                                                 fields=LIST_FIELDS).execute()
+
+                if file_blob['files']:
+                    found = file_blob['files'][0]
+                    size = found.get('size')
+
+                    self.downloadImage(found['id'],
+                                       filename,
+                                       md5=found.get('md5Checksum'),
+                                       size=int(size) if size else None)
+
+                    images[index], drive_files[index] = self.takeImage(filename)
+
+            status, body, normalized = convertImages(images,
+                                                     self.spool_size,
+                                                     self.this_dir,
+                                                     self.target_dpi,
+                                                     self.jpeg_quality)
+
+        if normalized:
+            with self.normalized_lock:
+                self.normalized_bytes[0] += normalized[0]
+                self.normalized_bytes[1] += normalized[1]
+
+        if status == 'incomplete':
+            print("Couldn't download all the images for {}".format(group_name))
+            return False
+
+        if status == 'failed':
+            print("Couldn't convert: {0} ({1})".format(group_name, body))
+            return False
+
+        if self.capture_hierarchy:
+            hierarchy = self.constructHierarchy(group_name)
+        else:
+            hierarchy = []
+
+        metadata = {
+            'hierarchy': json.dumps(hierarchy),
+            'election_name': self.election_name,
+            'election_slug': self.election_slug,
+            'image_id': str(uuid4()),
+        }
+
+        key = '{0}/{1}'.format(self.election_slug,
+                               '{}.pdf'.format(group_name))
+
+        if status == 'spooled':
+            pdf = open(body, 'rb')
+        else:
+            pdf = BytesIO(body)
+
+        try:
+            self.s3_client.upload_fileobj(pdf,
+                                          self.bucket,
+                                          key,
+                                          ExtraArgs={
+                                              'ACL': 'public-read',
+                                              'ContentType': 'application/pdf',
+                                              'Metadata': metadata,
+                                          },
+                                          Config=self.transfer_config)
+        finally:
+            pdf.close()
+
+            if status == 'spooled':
+                os.remove(body)
 
-            self.saveImage(key)
+        self.saveImage(key, metadata, hierarchy, group=group)
 
-            for title in filenames:
-                os.remove(os.path.join(self.this_dir, title))
+        return True
 
     def constructHierarchy(self, title):
         # geographies = title.split('-', 1)[1].rsplit('.', 1)[0]
@@ -279,6 +1057,16 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--election-name', type=str, help='Short name to be used under the hood for the election', required=True)
     parser.add_argument('-f', '--drive-folder', type=str, help='Name of the Google Drive folder to sync', required=True)
     parser.add_argument('--capture-hierarchy', action='store_true', help='Capture a geographical hierarchy from the name of the file.')
+    parser.add_argument('--download-parallelism', type=int, default=4, help='How many files to download from Google Drive at once.')
+    parser.add_argument('--convert-parallelism', type=int, default=os.cpu_count(), help='How many processes to convert images to PDFs with. 0 converts them in this process instead.')
+    parser.add_argument('--upload-parallelism', type=int, default=4, help='How many PDFs to upload to S3 at once.')
+    parser.add_argument('--queue-size', type=int, default=8, help='How many groups of images can wait to be converted, and to be uploaded.')
+    parser.add_argument('--spool-size', type=int, default=8, help='Images and PDFs bigger than this many MB are kept on disk rather than in memory. PDFs this big are uploaded in parts.')
+    parser.add_argument('--buffer-memory', type=int, default=256, help='How many MB of downloaded images to keep in memory at once before keeping them on disk.')
+    parser.add_argument('--resume', action='store_true', help='Carry on from where the last sync stopped rather than listing every folder again.')
+    parser.add_argument('--normalize', action='store_true', help='Rotate, scale down and recompress images before putting them in PDFs.')
+    parser.add_argument('--target-dpi', type=int, default=150, help='Resolution to scale images down to on a letter page when normalizing.')
+    parser.add_argument('--jpeg-quality', type=int, default=75, help='JPEG quality to recompress images with when normalizing.')
 
     args = parser.parse_args()
 
@@ -286,5 +1074,14 @@ if __name__ == "__main__":
                         google_creds=args.google_creds,
                         election_name=args.election_name,
                         drive_folder=args.drive_folder,
-                        capture_hierarchy=args.capture_hierarchy)
+                        capture_hierarchy=args.capture_hierarchy,
+                        download_parallelism=args.download_parallelism,
+                        convert_parallelism=args.convert_parallelism,
+                        upload_parallelism=args.upload_parallelism,
+                        queue_size=args.queue_size,
+                        spool_size=args.spool_size * 1024 * 1024,
+                        buffer_memory=args.buffer_memory * 1024 * 1024,
+                        resume=args.resume,
+                        target_dpi=args.target_dpi if args.normalize else None,
+                        jpeg_quality=args.jpeg_quality)
     syncer.sync()
@@ -0,0 +1,214 @@
+import json
+import os
+import sqlite3
+import threading
+
+class ImageManifest(object):
+    '''
+    Local cache of the metadata attached to the images in S3, kept in a
+    single SQLite file. Entries are keyed by S3 key and remember the ETag
+    of the object they were fetched for so that a replaced object is
+    fetched again rather than served stale.
+    '''
+
+    # SQLite won't take more than 999 parameters in one statement
+    LOOKUP_CHUNK_SIZE = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        with self.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS object_metadata (
+                  key TEXT PRIMARY KEY,
+                  etag TEXT,
+                  metadata TEXT NOT NULL
+                )
+            ''')
+
+            # What was in the old per-image JSON files. Those were named
+            # after the key without its election prefix or extension and
+            # had no ETag so they are only used until the key has an entry
+            # of its own.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS imported_metadata (
+                  name TEXT PRIMARY KEY,
+                  metadata TEXT NOT NULL
+                )
+            ''')
+
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS manifest_imports (
+                  folder TEXT PRIMARY KEY,
+                  imported INTEGER NOT NULL
+                )
+            ''')
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+
+            # Several queue workers can be refreshing images at once
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+
+            self.local.conn = conn
+
+        return conn
+
+    @staticmethod
+    def imageName(key):
+        image_name = key.split('/', 1)[-1]
+        return image_name.rsplit('.', 1)[0]
+
+    def lookup(self, objects):
+        '''
+        Find the cached metadata for a list of (key, etag) pairs. Returns a
+        dict of key to metadata for the ones we have an entry for with the
+        same ETag. Pass None for the ETag to take whatever is cached.
+
+        A key found among the imported entries is given an entry of its own
+        with the ETag it was looked up with, so that once the object is
+        replaced the imported metadata isn't used for it any more.
+        '''
+
+        objects = list(objects)
+        found = {}
+        promoted = []
+
+        conn = self.connection()
+
+        for i in range(0, len(objects), self.LOOKUP_CHUNK_SIZE):
+            chunk = objects[i:i + self.LOOKUP_CHUNK_SIZE]
+            keys = [key for key, _ in chunk]
+
+            rows = conn.execute('''
+                SELECT key, etag, metadata
+                FROM object_metadata
+                WHERE key IN ({})
+            '''.format(','.join('?' * len(keys))), keys)
+
+            cached = {key: (etag, metadata) for key, etag, metadata in rows}
+
+            missing = {}
+
+            for key, etag in chunk:
+                if key in cached:
+                    cached_etag, metadata = cached[key]
+
+                    if etag is None or cached_etag is None or cached_etag == etag:
+                        found[key] = json.loads(metadata)
+
+                else:
+                    missing[self.imageName(key)] = key
+
+            if not missing:
+                continue
+
+            etags = dict(chunk)
+            names = list(missing)
+
+            rows = conn.execute('''
+                SELECT name, metadata
+                FROM imported_metadata
+                WHERE name IN ({})
+            '''.format(','.join('?' * len(names))), names)
+
+            for name, metadata in rows:
+                key = missing[name]
+                found[key] = json.loads(metadata)
+
+                if etags[key] is not None:
+                    promoted.append((key, etags[key], metadata))
+
+        if promoted:
+            with conn:
+                conn.executemany('''
+                    INSERT OR IGNORE INTO object_metadata (key, etag, metadata)
+                    VALUES (?, ?, ?)
+                ''', promoted)
+
+        return found
+
+    def put(self, entries):
+        '''
+        Save a list of (key, etag, metadata) entries, replacing anything
+        already cached for those keys.
+        '''
+
+        conn = self.connection()
+
+        with conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO object_metadata (key, etag, metadata)
+                VALUES (?, ?, ?)
+            ''', [(key, etag, json.dumps(metadata))
+                  for key, etag, metadata in entries])
+
+    def invalidate(self, keys):
+        '''
+        Forget what we know about some keys so they are fetched again.
+        '''
+
+        keys = list(keys)
+        conn = self.connection()
+
+        with conn:
+            conn.executemany('DELETE FROM object_metadata WHERE key = ?',
+                             [(key,) for key in keys])
+
+            conn.executemany('DELETE FROM imported_metadata WHERE name = ?',
+                             [(self.imageName(key),) for key in keys])
+
+    def importJSON(self, folder):
+        '''
+        Load the per-image JSON files that used to be kept in folder. This
+        only happens once per folder, after that the files are left alone.
+        '''
+
+        folder = os.path.abspath(folder)
+        conn = self.connection()
+
+        already = conn.execute('SELECT 1 FROM manifest_imports WHERE folder = ?',
+                               (folder,)).fetchone()
+
+        if already or not os.path.exists(folder):
+            return 0
+
+        imported = 0
+        batch = []
+
+        def flush():
+            conn.executemany('''
+                INSERT OR IGNORE INTO imported_metadata (name, metadata)
+                VALUES (?, ?)
+            ''', batch)
+            del batch[:]
+
+        with conn:
+            for entry in os.scandir(folder):
+                if not entry.name.endswith('.json'):
+                    continue
+
+                try:
+                    with open(entry.path) as f:
+                        metadata = json.load(f)
+                except ValueError:
+                    continue
+
+                batch.append((entry.name[:-len('.json')], json.dumps(metadata)))
+                imported += 1
+
+                if len(batch) >= 1000:
+                    flush()
+
+            flush()
+
+            conn.execute('INSERT INTO manifest_imports (folder, imported) VALUES (?, ?)',
+                         (folder, imported))
+
+        return imported
@@ -8,7 +8,7 @@ from flask.ext.security.utils import md5
 from flask import current_app
 
 from sqlalchemy import Integer, String, Boolean, Column, Table, ForeignKey, \
-    DateTime, text, Text, or_, LargeBinary, MetaData, BigInteger
+    DateTime, text, Text, or_, LargeBinary, MetaData, BigInteger, Index
 from sqlalchemy.dialects.postgresql import JSONB, UUID, ARRAY
 from sqlalchemy.orm import synonym, backref, relationship
 
@@ -26,14 +26,74 @@ class WorkTable(db.Model):
     work_value = Column(LargeBinary)
     traceback = Column(Text)
     task_name = Column(String(255))
-    updated = Column(DateTime(timezone=True))
+    updated = Column(DateTime(timezone=True), server_default=text('NOW()'))
     claimed = Column(Boolean, server_default=text('FALSE'))
     cleared = Column(Boolean, server_default=text('TRUE'))
     completed = Column(Boolean, server_default=text('FALSE'))
+    failed = Column(Boolean, server_default=text('FALSE'))
+    attempts = Column(Integer, server_default=text('0'))
+    max_attempts = Column(Integer, server_default=text('1'))
+    retry_backoff = Column(Integer, server_default=text('30'))
+    lease_expires = Column(DateTime(timezone=True))
+    run_after = Column(DateTime(timezone=True))
+    # work_table is partitioned by month on created (see
+    # transcriber.queue.createWorkTable) which is why it's in the key
+    created = Column(DateTime(timezone=True),
+                     primary_key=True,
+                     server_default=text('NOW()'))
+    priority = Column(Integer, server_default=text('0'))
+    lane = Column(String(255), server_default=text("'default'"))
+    max_concurrency = Column(Integer)
+    parent_key = Column(String)
+    children_total = Column(Integer)
+    children_done = Column(Integer)
+    children_failed = Column(Integer)
+    coalesce_key = Column(String)
+    claimed_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index('work_table_unclaimed_idx',
+              text('priority DESC'),
+              'created',
+              postgresql_where=text('claimed = FALSE')),
+        Index('work_table_coalesce_idx',
+              'coalesce_key',
+              postgresql_where=text('completed = FALSE AND failed = FALSE')),
+        Index('work_table_active_idx',
+              'task_name',
+              postgresql_where=text('completed = FALSE AND failed = FALSE')),
+        Index('work_table_capped_idx',
+              'task_name',
+              postgresql_where=text('max_concurrency IS NOT NULL '
+                                    'AND completed = FALSE AND failed = FALSE')),
+    )
 
     def __repr__(self):
         return '<WorkTable {0}>'.format(str(self.key))
 
+class QueueWorker(db.Model):
+    __tablename__ = 'queue_worker'
+    id = Column(String, primary_key=True)
+    hostname = Column(String)
+    pid = Column(Integer)
+    lanes = Column(ARRAY(String))
+    started = Column(DateTime(timezone=True))
+    last_seen = Column(DateTime(timezone=True))
+    current_key = Column(String)
+
+    def __repr__(self):
+        return '<QueueWorker {0}>'.format(self.id)
+
+class QueueSchedule(db.Model):
+    __tablename__ = 'queue_schedule'
+    name = Column(String, primary_key=True)
+    last_run = Column(DateTime(timezone=True))
+    next_run = Column(DateTime(timezone=True))
+
+    def __repr__(self):
+        return '<QueueSchedule {0}>'.format(self.name)
+
 class Image(db.Model):
     __tablename__ = 'image'
     id = Column(UUID, primary_key=True)
@@ -43,6 +103,9 @@ class Image(db.Model):
     hierarchy = Column(ARRAY(Text))
     is_page_url = Column(Boolean)
     is_current = Column(Boolean)
+    added = Column(DateTime(timezone=True),
+                   server_default=text('NOW()'),
+                   index=True)
 
     def __repr__(self):
         return '<Image %r>' % self.fetch_url
@@ -119,6 +182,34 @@ def string_start_match(full_string, match_strings):
             return True
     return False
 
+class ImageObject(db.Model):
+    __tablename__ = 'image_object'
+    key = Column(String, primary_key=True)
+    election_name = Column(String, index=True)
+    image_id = Column(UUID)
+    etag = Column(String)
+    last_modified = Column(DateTime(timezone=True))
+
+    # Key ranges follow S3's listing order, which is byte order
+    __table_args__ = (
+        Index('image_object_election_key_idx',
+              'election_name',
+              text('key COLLATE "C"')),
+    )
+
+    def __repr__(self):
+        return '<ImageObject {0}>'.format(self.key)
+
+class ImageSyncCheckpoint(db.Model):
+    __tablename__ = 'image_sync_checkpoint'
+    range_key = Column(String, primary_key=True)
+    last_key = Column(String)
+    report = Column(JSONB)
+    updated = Column(DateTime(timezone=True))
+
+    def __repr__(self):
+        return '<ImageSyncCheckpoint {0}>'.format(self.range_key)
+
 class ImageTaskAssignment(db.Model):
     __tablename__ = 'image_task_assignment'
     id = Column(BigInteger, primary_key=True)
@@ -129,6 +220,12 @@ class ImageTaskAssignment(db.Model):
     view_count = Column(Integer, server_default=text('0'))
     is_complete = Column(Boolean, default=False)
 
+    __table_args__ = (
+        Index('image_task_assignment_checkout_idx',
+              'checkout_expire',
+              postgresql_where=text('checkout_expire IS NOT NULL')),
+    )
+
     def __repr__(self):
         return '<ImageTask %r %r>' % (self.image_id, self.form_id)
 
@@ -194,9 +291,11 @@ class ImageTaskAssignment(db.Model):
                                                            reviewer_count=reviewer_count)]
 
     @classmethod
-    def conflict_query(cls, task_id):
+    def conflict_query(cls, task_id, engine=None):
 
-        table_name = db.session.bind.execute(text('''
+        engine = engine or db.session.bind
+
+        table_name = engine.execute(text('''
             SELECT table_name FROM form_meta
             WHERE id = :form_id
         '''), form_id=task_id).first().table_name
@@ -205,7 +304,7 @@ class ImageTaskAssignment(db.Model):
             data_table = Table(table_name,
                             MetaData(),
                             autoload=True,
-                            autoload_with=db.session.bind)
+                            autoload_with=engine)
         except NoSuchTableError:
             return None
 
@@ -249,14 +348,22 @@ class ImageTaskAssignment(db.Model):
                                                    form_id=task_id)]
 
     @classmethod
-    def get_task_progress(cls, task_id):
+    def get_task_progress(cls, task_id, engine=None):
+        '''
+        Counts of where a task's documents are at. Runs on the app's
+        session unless given an engine or connection to use instead, which
+        lets it run outside of a Flask app.
+        '''
         progress_dict = {}
-        reviewer_count = db.session.query(FormMeta).get(task_id).reviewer_count
+
+        engine = engine or db.session.bind
+
+        reviewer_count = engine.execute(text('''
+            SELECT reviewer_count FROM form_meta WHERE id = :task_id
+        '''), task_id=task_id).first().reviewer_count
         if reviewer_count == None: # clean this up
             reviewer_count = 1
 
-        engine = db.session.bind
-
         doc_counts = '''
             SELECT
               COUNT(*) AS count,
@@ -292,7 +399,7 @@ class ImageTaskAssignment(db.Model):
             FROM (
               {conflict_query}
             ) As conflict
-        '''.format(conflict_query=cls.conflict_query(task_id))
+        '''.format(conflict_query=cls.conflict_query(task_id, engine=engine))
 
         unseen = '''
             SELECT COUNT(*) AS count
@@ -345,6 +452,34 @@ class ImageTaskAssignment(db.Model):
 
         return progress_dict
 
+    @classmethod
+    def get_rolled_up_task_progress(cls, task_id, max_age=600):
+        '''
+        Progress as of the last rollup_task_progress run, if that was less
+        than max_age seconds ago. Otherwise work it out on the spot.
+        '''
+
+        rolled_up = db.session.bind.execute(text('''
+            SELECT progress FROM task_progress
+            WHERE form_id = :task_id
+              AND updated >= NOW() - (:max_age * INTERVAL '1 second')
+        '''), task_id=task_id, max_age=max_age).first()
+
+        if rolled_up:
+            return rolled_up.progress
+
+        return cls.get_task_progress(task_id)
+
+
+class TaskProgress(db.Model):
+    __tablename__ = 'task_progress'
+    form_id = Column(Integer, ForeignKey('form_meta.id'), primary_key=True)
+    progress = Column(JSONB)
+    updated = Column(DateTime(timezone=True))
+
+    def __repr__(self):
+        return '<TaskProgress %r>' % self.form_id
+
 
 class TaskGroup(db.Model):
     __tablename__ = 'task_group'
@@ -391,6 +526,7 @@ class FormMeta(db.Model):
     election_name = Column(String)
     hierarchy_filter = Column(ARRAY(Text()))
     split_image = Column(Boolean)
+    images_seeded_through = Column(DateTime(timezone=True))
 
     def __repr__(self):
         return '<FormMeta %r>' % self.id
@@ -1,15 +1,26 @@
+import os
 import pickle
+import hashlib
+import re
+from datetime import datetime, timedelta
 from uuid import uuid4
+from functools import partial
 import threading
+import multiprocessing
+import queue
 import select
+import signal
+import socket
+import time
 import traceback
 import json
 
 import sqlalchemy as sa
+from sqlalchemy.schema import CreateTable
 
 import psycopg2
 
-from transcriber.models import WorkTable
+from transcriber.models import WorkTable, QueueWorker, QueueSchedule
 from transcriber.app_config import DB_CONN
 
 try:
@@ -21,53 +32,640 @@ except ImportError: # pragma: no cover
 except KeyError:
     client = None
 
-def queuefunc(f):
+# Completed and failed jobs are kept around for this long before the
+# monthly work_table partitions holding them get dropped (or, with
+# WORK_ARCHIVE_PARTITIONS, detached and kept as standalone tables).
+try:
+    from transcriber.app_config import WORK_RETENTION_DAYS
+except ImportError:
+    WORK_RETENTION_DAYS = 90
+
+try:
+    from transcriber.app_config import WORK_ARCHIVE_PARTITIONS
+except ImportError:
+    WORK_ARCHIVE_PARTITIONS = False
+
+# How long a claimed job belongs to a worker without a heartbeat. Workers
+# renew the lease every LEASE_SECONDS / 3 so a job is only reclaimed once
+# the worker running it has really gone away.
+LEASE_SECONDS = 60
+
+# Key for the advisory lock that serializes claims of capped jobs (see
+# claimWork)
+CLAIM_LOCK_ID = 8675309
+
+# First half of the two part advisory lock keys taken while checking for
+# a duplicate job (see insertWork). Kept apart from CLAIM_LOCK_ID which
+# lives in the (0, n) part of the lock space.
+COALESCE_LOCK_CLASS = 1
+
+DEFAULT_LANE = 'default'
+
+def queuefunc(f=None,
+              max_attempts=1,
+              retry_backoff=30,
+              priority=0,
+              lane=DEFAULT_LANE,
+              concurrency=None,
+              coalesce=False):
+    '''
+    Decorator that adds a ``delay`` method to a function which runs it on
+    the queue instead of inline. Can be used bare (``@queuefunc``) or with
+    options (``@queuefunc(max_attempts=3)``).
+
+    A failed job is tried again up to ``max_attempts`` times in total,
+    waiting ``retry_backoff`` seconds before the first retry and doubling
+    that wait each time.
+
+    Jobs with a higher ``priority`` are claimed first. ``lane`` names the
+    group of workers that should run the job (see ``run_queue.py --lanes``)
+    and ``concurrency`` caps how many jobs for this function run at once
+    across every worker. ``enqueue`` can override the priority and lane for
+    a single job.
+
+    With ``coalesce`` a job that duplicates one that is still waiting or
+    running isn't queued again; the key of the existing job is returned
+    instead. ``coalesce=True`` treats jobs for this function with the same
+    arguments as duplicates. It can also be a function that takes the job's
+    arguments and returns a key string (or None to always queue the job).
+    '''
+
+    if f is None:
+        return partial(queuefunc,
+                       max_attempts=max_attempts,
+                       retry_backoff=retry_backoff,
+                       priority=priority,
+                       lane=lane,
+                       concurrency=concurrency,
+                       coalesce=coalesce)
+
+    def enqueue_many(calls, priority=priority, lane=lane):
+
+        rows = [workRow(f, args, kwargs, priority=priority, lane=lane)
+                for args, kwargs in calls]
+
+        return insertWork(rows)
+
+    def enqueue(args=(), kwargs=None, priority=priority, lane=lane):
+        return enqueue_many([(args, kwargs)],
+                            priority=priority,
+                            lane=lane)[0]
 
     def delay(*args, **kwargs):
-        
-        engine = sa.create_engine(DB_CONN)
-        
-        pickled_task = pickle.dumps((f, args, kwargs))
-        key = str(uuid4())
+        return enqueue(args, kwargs)
 
-        task_name = f.__name__
-        
-        query_args = {
-            'key': key,
-            'value': pickled_task,
-            'task_name': task_name,
-        }
-        
-        with engine.begin() as conn:
-            conn.execute(sa.text(''' 
-                INSERT INTO work_table
-                    (key, work_value, task_name, updated, claimed) 
-                VALUES ( 
-                  :key, 
-                  :value, 
-                  :task_name, 
-                  NOW(),
-                  FALSE
-                )
-            '''), **query_args)
-            
-            conn.execute("NOTIFY worker, '{}'".format(key))
-        
-        return key
+    def delay_many(calls, priority=priority, lane=lane):
+        '''
+        Queue up a job for each ``(args, kwargs)`` pair in ``calls`` in one
+        transaction using multi-row INSERTs and a single NOTIFY. Returns the
+        list of job keys in the same order.
+        '''
+        return enqueue_many(calls, priority=priority, lane=lane)
 
+    f.queue_options = {
+        'max_attempts': max_attempts,
+        'retry_backoff': retry_backoff,
+        'priority': priority,
+        'lane': lane,
+        'max_concurrency': concurrency,
+    }
+    f.coalesce = coalesce
     f.delay = delay
+    f.delay_many = delay_many
+    f.enqueue = enqueue
     return f
 
+# Name -> (function, interval in seconds) for everything decorated with
+# periodic. Filled in when the modules holding them get imported.
+PERIODIC_JOBS = {}
+
+def periodic(seconds, **options):
+    '''
+    Decorator for maintenance jobs the queue daemon should run every
+    ``seconds`` seconds. The function is also made into a ``queuefunc``
+    (taking the same ``options``) that coalesces, so however many daemons
+    are running on however many hosts only one copy of the job is ever
+    waiting or running.
+    '''
+
+    options.setdefault('coalesce', True)
+
+    def decorator(f):
+        f = queuefunc(f, **options)
+        PERIODIC_JOBS[f.__name__] = (f, seconds)
+        return f
+
+    return decorator
+
+class FanOut(object):
+    '''
+    Return one of these from a queued function to split its work up into
+    child jobs that run on any free worker.
+
+    ``children`` is a list of ``(func, args, kwargs)`` where ``func`` is
+    a ``queuefunc``. The parent job stays open, with its progress in its
+    return value, until every child has finished. If ``reduce`` is given as
+    a ``(func, args, kwargs)`` it then runs once as the parent job itself
+    and its result becomes the parent's result.
+    '''
+
+    def __init__(self, children, reduce=None):
+        self.children = list(children)
+        self.reduce = reduce
+
+def workRow(f, args=(), kwargs=None, parent_key=None, **overrides):
+    options = dict(f.queue_options, **overrides)
+
+    row = {
+        'key': str(uuid4()),
+        'work_value': pickle.dumps((f, tuple(args), kwargs or {})),
+        'task_name': f.__name__,
+        'claimed': False,
+        'parent_key': parent_key,
+        'coalesce_key': coalesceKey(f, args, kwargs or {}),
+    }
+    row.update(options)
+
+    return row
+
+def coalesceKey(f, args, kwargs):
+
+    if not f.coalesce:
+        return None
+
+    if f.coalesce is True:
+        arguments = json.dumps([args, kwargs], sort_keys=True, default=str)
+        digest = hashlib.sha1(arguments.encode('utf-8')).hexdigest()
+        return '{0}:{1}'.format(f.__name__, digest)
+
+    key = f.coalesce(*args, **kwargs)
+
+    if key is not None:
+        return '{0}:{1}'.format(f.__name__, key)
+
+def getEngine():
+    '''
+    Engine shared by everything in this process that puts work on the
+    queue. Child processes get their own since pooled connections can't be
+    shared across a fork.
+    '''
+    global _engine, _engine_pid
+
+    if _engine is None or _engine_pid != os.getpid():
+        _engine = sa.create_engine(DB_CONN)
+        _engine_pid = os.getpid()
+
+    return _engine
+
+_engine = None
+_engine_pid = None
+
+# Rows per INSERT statement. Keeps statements for very large batches from
+# getting out of hand while still making thousands of jobs a handful of
+# round trips.
+INSERT_CHUNK_SIZE = 1000
+
+def insertWork(rows, conn=None):
+    '''
+    Put rows built by workRow on the queue and return their keys. Rows
+    that duplicate a job that is still waiting or running are dropped and
+    the existing job's key is returned in their place.
+    '''
+
+    if not rows:
+        return []
+
+    if conn is None:
+        with getEngine().begin() as conn:
+            return insertWork(rows, conn=conn)
+
+    keys = [row['key'] for row in rows]
+
+    coalesce_keys = {row['coalesce_key'] for row in rows if row['coalesce_key']}
+
+    if coalesce_keys:
+        existing = coalescedWork(conn, coalesce_keys)
+
+        new_rows = []
+        for index, row in enumerate(rows):
+            coalesce_key = row['coalesce_key']
+
+            if coalesce_key in existing:
+                keys[index] = existing[coalesce_key]
+            else:
+                new_rows.append(row)
+
+                # Also catches duplicates within this batch
+                if coalesce_key:
+                    existing[coalesce_key] = row['key']
+
+        rows = new_rows
+
+    work_table = WorkTable.__table__
+
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        chunk = rows[start:start + INSERT_CHUNK_SIZE]
+        conn.execute(work_table.insert().values(chunk))
+
+    if rows:
+        # Workers claim whatever is waiting so one NOTIFY covers the lot
+        conn.execute("NOTIFY worker, '{}'".format(len(rows)))
+
+    return keys
+
+def coalescedWork(conn, coalesce_keys):
+
+    # Whoever gets the lock for a key first decides whether to queue a new
+    # job, and anyone else has to wait until that job is committed and
+    # visible to the lookup below. Locks are taken in a fixed order so two
+    # batches with overlapping keys can't deadlock.
+    for coalesce_key in sorted(coalesce_keys):
+        conn.execute(sa.text('''
+            SELECT pg_advisory_xact_lock(:lock_class, hashtext(:coalesce_key))
+        '''), lock_class=COALESCE_LOCK_CLASS, coalesce_key=coalesce_key)
+
+    existing = conn.execute(sa.text('''
+        SELECT DISTINCT ON (coalesce_key) coalesce_key, key
+        FROM work_table
+        WHERE coalesce_key = ANY(:coalesce_keys)
+          AND completed = FALSE
+          AND failed = FALSE
+        ORDER BY coalesce_key, created
+    '''), coalesce_keys=list(coalesce_keys))
+
+    return {row.coalesce_key: row.key for row in existing}
+
+# How many months of work_table partitions to keep ready ahead of time
+PARTITIONS_AHEAD = 2
+
+PARTITION_NAME = re.compile(r'^work_table_y(\d{4})m(\d{2})$')
+
+def createWorkTable(engine):
+    '''
+    Create work_table, partitioned by month on created, if it isn't there
+    yet. The alembic migrations do the same thing for existing databases.
+    Needs PostgreSQL 11 or later.
+    '''
+
+    work_table = WorkTable.__table__
+
+    if work_table.exists(bind=engine):
+        return
+
+    create = str(CreateTable(work_table).compile(bind=engine)).rstrip()
+
+    with engine.begin() as conn:
+        conn.execute('{} PARTITION BY RANGE (created)'.format(create))
+        conn.execute('''
+            CREATE TABLE work_table_default PARTITION OF work_table DEFAULT
+        ''')
+
+        for index in work_table.indexes:
+            index.create(conn)
+
+def ensureWorkPartitions(conn, months_ahead=PARTITIONS_AHEAD):
+
+    months = conn.execute(sa.text('''
+        SELECT generate_series(
+          date_trunc('month', NOW() AT TIME ZONE 'UTC'),
+          date_trunc('month', NOW() AT TIME ZONE 'UTC')
+            + (:months_ahead * INTERVAL '1 month'),
+          INTERVAL '1 month'
+        ) AS start
+    '''), months_ahead=months_ahead)
+
+    for month in months:
+        start = month.start
+        end = (start + timedelta(days=32)).replace(day=1)
+
+        bounds = {
+            'name': 'work_table_y{0:%Y}m{0:%m}'.format(start),
+            'start': '{0:%Y-%m-%d}+00'.format(start),
+            'end': '{0:%Y-%m-%d}+00'.format(end),
+        }
+
+        exists = conn.execute(sa.text('SELECT to_regclass(:name) IS NOT NULL'),
+                              name=bounds['name']).scalar()
+
+        if exists:
+            continue
+
+        create = '''
+            CREATE TABLE {name}
+            PARTITION OF work_table
+            FOR VALUES FROM ('{start}') TO ('{end}')
+        '''.format(**bounds)
+
+        # Jobs for the month may have gone into the default partition if
+        # the daemon wasn't around to make this one in time, in which case
+        # Postgres won't let us create it. Take the default partition out
+        # of the way, make the new one and move the jobs into it.
+        stranded = conn.execute(sa.text('''
+            SELECT EXISTS (
+              SELECT 1 FROM work_table_default
+              WHERE created >= CAST(:start AS TIMESTAMP WITH TIME ZONE)
+                AND created < CAST(:end AS TIMESTAMP WITH TIME ZONE)
+            )
+        '''), start=bounds['start'], end=bounds['end']).scalar()
+
+        if not stranded:
+            conn.execute(create)
+            continue
+
+        conn.execute('ALTER TABLE work_table DETACH PARTITION work_table_default')
+        conn.execute(create)
+        conn.execute('''
+            WITH moved AS (
+              DELETE FROM work_table_default
+              WHERE created >= '{start}'
+                AND created < '{end}'
+              RETURNING *
+            )
+            INSERT INTO work_table
+            SELECT * FROM moved
+        '''.format(**bounds))
+        conn.execute('ALTER TABLE work_table ATTACH PARTITION work_table_default DEFAULT')
+
+def pruneWorkPartitions(conn,
+                        retention_days=WORK_RETENTION_DAYS,
+                        archive=WORK_ARCHIVE_PARTITIONS):
+    '''
+    Drop (or detach, when archiving) the monthly partitions that ended more
+    than retention_days ago. Partitions that still have a job waiting or
+    running are left alone. Returns the names of the partitions removed.
+    '''
+
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+    partitions = conn.execute('''
+        SELECT child.relname AS name
+        FROM pg_inherits
+        JOIN pg_class AS child
+          ON pg_inherits.inhrelid = child.oid
+        WHERE pg_inherits.inhparent = 'work_table'::regclass
+        ORDER BY child.relname
+    ''')
+
+    pruned = []
+
+    for partition in partitions:
+        match = PARTITION_NAME.match(partition.name)
+
+        if not match:
+            continue
+
+        year, month = int(match.group(1)), int(match.group(2))
+        end = (datetime(year, month, 1) + timedelta(days=32)).replace(day=1)
+
+        if end > cutoff:
+            continue
+
+        active = conn.execute('''
+            SELECT EXISTS(
+              SELECT 1 FROM {}
+              WHERE completed = FALSE
+                AND failed = FALSE
+            ) AS active
+        '''.format(partition.name)).first().active
+
+        if active:
+            continue
+
+        if archive:
+            conn.execute('''
+                ALTER TABLE work_table DETACH PARTITION {0}
+            '''.format(partition.name))
+            conn.execute('''
+                ALTER TABLE {0} RENAME TO {1}
+            '''.format(partition.name,
+                       partition.name.replace('work_table_', 'work_table_archive_')))
+        else:
+            conn.execute('DROP TABLE {}'.format(partition.name))
+
+        pruned.append(partition.name)
+
+    return pruned
+
+# Job status updates go out on this channel as JSON with at least the
+# job's key and state. See the /work-events/ view for the listening end.
+STATUS_CHANNEL = 'job_status'
+
+# Key of the job running in the current thread (see reportProgress)
+current_job = threading.local()
+
+def publishStatus(conn, key, state, **extra):
+    '''
+    NOTIFY anyone listening on STATUS_CHANNEL that a job changed state. Goes
+    out when conn's transaction commits, so it never gets ahead of what is
+    in work_table.
+    '''
+
+    payload = dict(extra, key=key, state=state)
+
+    conn.execute(sa.text('SELECT pg_notify(:channel, :payload)'),
+                 channel=STATUS_CHANNEL,
+                 payload=json.dumps(payload, default=str))
+
+def reportProgress(**progress):
+    '''
+    Called from inside a queued function to let whoever is waiting on it
+    know how it's getting on. The progress is kept as the job's return
+    value until the job finishes.
+    '''
+
+    key = getattr(current_job, 'key', None)
+
+    if not key:
+        return
+
+    upd = '''
+        UPDATE work_table SET
+          return_value = :progress,
+          updated = NOW()
+        WHERE key = :key
+    '''
+
+    with getEngine().begin() as conn:
+        conn.execute(sa.text(upd), key=key, progress=json.dumps(progress))
+        publishStatus(conn, key, 'running', progress=progress)
+
+class StatusListener(threading.Thread):
+    '''
+    Keeps a single connection per process LISTENing on STATUS_CHANNEL and
+    hands each status it hears to whoever is waiting on that job, so that
+    following a job doesn't cost a connection per request. Use
+    statusListener() to get the one for this process.
+    '''
+
+    def __init__(self):
+        super().__init__(daemon=True)
+
+        self.lock = threading.Lock()
+        self.waiters = {}
+
+    def subscribe(self, key):
+        '''
+        Returns a queue.Queue that the statuses published for key are put
+        on until unsubscribe is called with it.
+        '''
+
+        waiter = queue.Queue()
+
+        with self.lock:
+            self.waiters.setdefault(key, []).append(waiter)
+
+        return waiter
+
+    def unsubscribe(self, key, waiter):
+
+        with self.lock:
+            waiters = self.waiters.get(key, [])
+
+            if waiter in waiters:
+                waiters.remove(waiter)
+
+            if not waiters:
+                self.waiters.pop(key, None)
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except (psycopg2.Error, sa.exc.DBAPIError):
+                traceback.print_exc()
+
+            # Anyone waiting while we're away times out and asks again
+            time.sleep(5)
+
+    def listen(self):
+        # Taken out of the pool for good since it's left LISTENing in
+        # autocommit mode
+        conn = getEngine().raw_connection()
+        conn.detach()
+
+        listener = conn.connection
+        listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        try:
+            curs = listener.cursor()
+            curs.execute('LISTEN {}'.format(STATUS_CHANNEL))
+
+            while True:
+                if select.select([listener], [], [], 60) == ([], [], []):
+                    continue
+
+                listener.poll()
+
+                while listener.notifies:
+                    notify = listener.notifies.pop(0)
+
+                    try:
+                        status = json.loads(notify.payload)
+                    except ValueError:
+                        continue
+
+                    with self.lock:
+                        waiters = list(self.waiters.get(status.get('key'), []))
+
+                    for waiter in waiters:
+                        waiter.put(status)
+        finally:
+            conn.close()
+
+_status_listener = None
+_status_listener_pid = None
+_status_listener_lock = threading.Lock()
+
+def statusListener():
+    global _status_listener, _status_listener_pid
+
+    with _status_listener_lock:
+        if _status_listener is None or _status_listener_pid != os.getpid():
+            _status_listener = StatusListener()
+            _status_listener.start()
+            _status_listener_pid = os.getpid()
+
+    return _status_listener
+
+class Scheduler(threading.Thread):
+    '''
+    Queues up the periodic jobs when they're due. Every daemon runs one of
+    these; queue_schedule keeps track of when each job last ran so that
+    only one of them queues the job each time around.
+    '''
+
+    def __init__(self, stopper, tick=10):
+        super().__init__(daemon=True)
+        self.stopper = stopper
+        self.tick = tick
+
+    def run(self):
+        while not self.stopper.wait(self.tick):
+            try:
+                self.schedule()
+            except sa.exc.DBAPIError:
+                traceback.print_exc()
+
+    def schedule(self):
+
+        register = '''
+            INSERT INTO queue_schedule (name, next_run)
+            VALUES (:name, NOW())
+            ON CONFLICT (name) DO NOTHING
+        '''
+
+        # Whoever updates the row first gets to queue the job. Anyone else
+        # either waits on the row lock and then sees next_run in the future
+        # or comes along after and sees the same.
+        claim = '''
+            UPDATE queue_schedule SET
+              last_run = NOW(),
+              next_run = NOW() + (:seconds * INTERVAL '1 second')
+            WHERE name = :name
+              AND next_run <= NOW()
+            RETURNING name
+        '''
+
+        for name, (func, seconds) in sorted(PERIODIC_JOBS.items()):
+            with getEngine().begin() as conn:
+                conn.execute(sa.text(register), name=name)
+
+                due = conn.execute(sa.text(claim),
+                                   name=name,
+                                   seconds=seconds).first()
+
+                if due:
+                    insertWork([workRow(func)], conn=conn)
+
+@periodic(60 * 60)
+def maintain_work_table():
+    with getEngine().begin() as conn:
+        ensureWorkPartitions(conn)
+        pruned = pruneWorkPartitions(conn)
+
+        # Workers that went away without cleaning up after themselves
+        conn.execute('''
+            DELETE FROM queue_worker
+            WHERE last_seen < NOW() - INTERVAL '1 day'
+        ''')
+
+    if pruned:
+        print('Removed old work_table partitions: {}'.format(', '.join(pruned)))
+
+    return pruned
+
 class ProcessMessage(threading.Thread):
     stopper = None
 
-    def __init__(self, stopper):
+    def __init__(self, stopper, work_queue, worker_count=1):
         super().__init__()
         
         engine = sa.create_engine(DB_CONN)
         
         self.engine = engine
         self.stopper = stopper
+        self.work_queue = work_queue
+        self.worker_count = worker_count
         
         self.conn = self.engine.raw_connection()
         self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
@@ -82,48 +680,382 @@ class ProcessMessage(threading.Thread):
             if not select.select([self.conn],[],[],5) == ([],[],[]):
                 
                 self.conn.poll()
-                
-                while self.conn.notifies:
-                    notify = self.conn.notifies.pop(0)
-                    
-                    work = self.getWork(notify.payload)
-                    
-                    if work:
+
+                if self.conn.notifies:
+                    del self.conn.notifies[:]
+
+                    # The payload doesn't matter anymore since workers
+                    # claim whatever is waiting in work_table. Wake all of
+                    # them so a burst of jobs gets spread across the pool.
+                    for _ in range(self.worker_count):
+                        self.work_queue.put(None)
+
+
+class WorkerMixin(object):
+    stopper = None
+    work_queue = None
+    batch_size = 1
+    lanes = None
+
+    def setup(self, stopper, work_queue, batch_size=1, lanes=None):
+        self.stopper = stopper
+        self.work_queue = work_queue
+        self.batch_size = batch_size
+        self.lanes = lanes
+
+    def run(self):
+        # The engine is looked up here rather than in __init__ so that
+        # process based workers get their own connection pool after the
+        # fork instead of sharing the parent's sockets.
+        self.engine = getEngine()
+
+        self.held_keys = set()
+        self.held_lock = threading.Lock()
+        self.current_key = None
+
+        self.worker_id = '{0}:{1}:{2}'.format(socket.gethostname(),
+                                              os.getpid(),
+                                              self.name)
+        self.registerWorker()
+
+        # Stopped when this worker is done for whatever reason so that a
+        # worker that died doesn't carry on looking alive
+        self.heartbeat_stopper = threading.Event()
+
+        heartbeat = threading.Thread(target=self.heartbeat, daemon=True)
+        heartbeat.start()
+
+        backoff = 0
+
+        try:
+            while not self.stopper.is_set():
+
+                # Drain anything that is already waiting. This picks up
+                # work that was added while the daemon was down or while
+                # every worker was busy, not just the rows we were
+                # notified about.
+                try:
+                    self.drainWork()
+                    backoff = 0
+                except sa.exc.DBAPIError:
+                    # Most likely the database went away. Wait for it to
+                    # come back rather than giving up on this worker.
+                    traceback.print_exc()
+
+                    backoff = min(backoff * 2 or 1, 60)
+                    self.stopper.wait(backoff)
+
+                    continue
+
+                try:
+                    self.work_queue.get(timeout=5)
+                except queue.Empty:
+                    pass
+
+        finally:
+            self.heartbeat_stopper.set()
+            heartbeat.join()
+
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(sa.text('DELETE FROM queue_worker WHERE id = :id'),
+                                 id=self.worker_id)
+            except sa.exc.DBAPIError:
+                traceback.print_exc()
+
+    def registerWorker(self):
+
+        ins = '''
+            INSERT INTO queue_worker (
+              id,
+              hostname,
+              pid,
+              lanes,
+              started,
+              last_seen
+            ) VALUES (
+              :id,
+              :hostname,
+              :pid,
+              :lanes,
+              NOW(),
+              NOW()
+            )
+            ON CONFLICT (id) DO UPDATE SET
+              started = NOW(),
+              last_seen = NOW(),
+              current_key = NULL
+        '''
+
+        with self.engine.begin() as conn:
+            conn.execute(sa.text(ins),
+                         id=self.worker_id,
+                         hostname=socket.gethostname(),
+                         pid=os.getpid(),
+                         lanes=self.lanes)
+
+    def drainWork(self):
+        while not self.stopper.is_set():
+            batch = self.claimWork()
+
+            if not batch:
+                break
+
+            with self.held_lock:
+                self.held_keys.update(w.key for w in batch)
+
+            try:
+                for index, work in enumerate(batch):
+                    if self.stopper.is_set():
+                        self.releaseWork([w.key for w in batch[index:]])
+                        return
+
+                    self.current_key = work.key
+
+                    try:
                         self.doWork(work)
+                    finally:
+                        self.current_key = None
+
+                        with self.held_lock:
+                            self.held_keys.discard(work.key)
+            finally:
+                # Whatever we didn't get to is no longer kept alive so its
+                # lease runs out and someone else picks it up
+                with self.held_lock:
+                    self.held_keys.difference_update(w.key for w in batch)
+
+    def heartbeat(self):
+        while not self.heartbeat_stopper.wait(LEASE_SECONDS / 3):
+
+            with self.held_lock:
+                held_keys = list(self.held_keys)
+
+            upd = '''
+                UPDATE work_table SET
+                  lease_expires = NOW() + (:lease_seconds * INTERVAL '1 second')
+                WHERE key = ANY(:work_keys)
+                  AND claimed = TRUE
+                  AND completed = FALSE
+                  AND lease_expires IS NOT NULL
+            '''
+
+            beat = '''
+                UPDATE queue_worker SET
+                  last_seen = NOW(),
+                  current_key = :current_key
+                WHERE id = :id
+            '''
+            
+            try:
+                with self.engine.begin() as conn:
+                    if held_keys:
+                        conn.execute(sa.text(upd),
+                                     work_keys=held_keys,
+                                     lease_seconds=LEASE_SECONDS)
+
+                    conn.execute(sa.text(beat),
+                                 id=self.worker_id,
+                                 current_key=self.current_key)
+            except sa.exc.DBAPIError:
+                # Try again on the next beat. If the database stays away
+                # long enough the lease runs out and another worker
+                # picks the job up, which is what we want anyways.
+                traceback.print_exc()
     
-    def getWork(self, work_key):
+    def claimWork(self):
         
         with self.engine.begin() as trans:
+
+            # Jobs whose lease ran out on their last allowed attempt are
+            # not going to be tried again, so record them as failed.
+            reap = '''
+                UPDATE work_table SET
+                  failed = TRUE,
+                  lease_expires = NULL,
+                  finished_at = NOW(),
+                  updated = NOW()
+                WHERE claimed = TRUE
+                  AND completed = FALSE
+                  AND failed = FALSE
+                  AND lease_expires < NOW()
+                  AND attempts >= max_attempts
+                RETURNING key, parent_key
+            '''
+            for reaped in trans.execute(sa.text(reap)).fetchall():
+                publishStatus(trans, reaped.key, 'failed')
+
+                if reaped.parent_key:
+                    self.childFinished(trans, reaped.parent_key, True)
             
+            params = {
+                'batch_size': self.batch_size,
+                'lease_seconds': LEASE_SECONDS,
+            }
+
+            lane_filter = ''
+            if self.lanes:
+                lane_filter = 'AND w.lane = ANY(:lanes)'
+                params['lanes'] = self.lanes
+
+            # Rows whose lease has expired belonged to a worker that died
+            # and are reclaimed.
+            waiting = '''
+                w.completed = FALSE
+                AND w.failed = FALSE
+                AND w.attempts < w.max_attempts
+                AND (
+                  (w.claimed = FALSE
+                   AND (w.run_after IS NULL OR w.run_after <= NOW()))
+                  OR (w.claimed = TRUE AND w.lease_expires < NOW())
+                )
+                {lane_filter}
+            '''.format(lane_filter=lane_filter)
+
+            # Jobs without a concurrency cap are locked with SKIP LOCKED as
+            # they're picked so that several daemons can claim at once
+            # without waiting on each other or getting the same row.
+            candidates = '''
+                uncapped AS (
+                  SELECT w.key, w.priority, w.created
+                  FROM work_table AS w
+                  WHERE w.max_concurrency IS NULL
+                    AND {waiting}
+                  ORDER BY w.priority DESC, w.created
+                  LIMIT :batch_size
+                  FOR UPDATE SKIP LOCKED
+                )
+            '''.format(waiting=waiting)
+
+            candidate_sets = ['uncapped']
+
+            capped = trans.execute(sa.text('''
+                SELECT EXISTS (
+                  SELECT 1 FROM work_table
+                  WHERE max_concurrency IS NOT NULL
+                    AND completed = FALSE
+                    AND failed = FALSE
+                )
+            ''')).scalar()
+
+            if capped:
+                # The caps depend on what everyone else is running so
+                # claims that might include a capped job are taken one at
+                # a time across all daemons. Waiting capped jobs are ranked
+                # within their task so that, on top of what is already
+                # running, no task goes over its cap.
+                trans.execute(sa.text('SELECT pg_advisory_xact_lock(:lock_id)'),
+                              lock_id=CLAIM_LOCK_ID)
+
+                candidates += ''',
+                running AS (
+                  SELECT task_name, COUNT(*) AS running
+                  FROM work_table
+                  WHERE max_concurrency IS NOT NULL
+                    AND claimed = TRUE
+                    AND completed = FALSE
+                    AND failed = FALSE
+                    AND lease_expires >= NOW()
+                  GROUP BY task_name
+                ),
+                ranked AS (
+                  SELECT
+                    w.key,
+                    w.priority,
+                    w.created,
+                    w.max_concurrency,
+                    COALESCE(r.running, 0) + ROW_NUMBER() OVER (
+                      PARTITION BY w.task_name
+                      ORDER BY w.priority DESC, w.created
+                    ) AS slot
+                  FROM work_table AS w
+                  LEFT JOIN running AS r
+                    ON w.task_name = r.task_name
+                  WHERE w.max_concurrency IS NOT NULL
+                    AND {waiting}
+                ),
+                capped AS (
+                  SELECT key, priority, created
+                  FROM work_table
+                  WHERE key IN (
+                    SELECT key
+                    FROM ranked
+                    WHERE slot <= max_concurrency
+                    ORDER BY priority DESC, created
+                    LIMIT :batch_size
+                  )
+                  FOR UPDATE SKIP LOCKED
+                )
+                '''.format(waiting=waiting)
+
+                candidate_sets.append('capped')
+
             upd = '''
+                WITH {candidates},
+                eligible AS (
+                  SELECT key
+                  FROM ({candidate_sets}) AS c
+                  ORDER BY priority DESC, created
+                  LIMIT :batch_size
+                )
                 UPDATE work_table SET 
                   claimed = TRUE,
+                  attempts = work_table.attempts + 1,
+                  lease_expires = NOW() + (:lease_seconds * INTERVAL '1 second'),
+                  claimed_at = NOW(),
                   updated = NOW()
-                FROM (
-                  SELECT * FROM work_table
-                  WHERE key = :work_key
-                    AND claimed = FALSE
-                  FOR UPDATE
-                ) AS s
-                WHERE work_table.key = s.key
+                FROM eligible
+                WHERE work_table.key = eligible.key
                 RETURNING work_table.*
-            '''
-            work = trans.execute(sa.text(upd), 
-                                 work_key=work_key).first()
+            '''.format(candidates=candidates,
+                       candidate_sets=' UNION ALL '.join('SELECT * FROM {}'.format(c)
+                                                         for c in candidate_sets))
+            work = trans.execute(sa.text(upd), **params).fetchall()
+
+            for claimed in work:
+                publishStatus(trans, claimed.key, 'running')
         
-        return work
+        return sorted(work, key=lambda w: (-w.priority, w.created))
 
-    def doWork(self, work):
+    def releaseWork(self, work_keys):
         
-        func, args, kwargs = pickle.loads(work.work_value)
+        with self.engine.begin() as trans:
+            
+            # These were never started so they shouldn't count as an attempt
+            upd = '''
+                UPDATE work_table SET
+                  claimed = FALSE,
+                  attempts = attempts - 1,
+                  lease_expires = NULL
+                WHERE key = ANY(:work_keys)
+                  AND completed = FALSE
+            '''
+            trans.execute(sa.text(upd), work_keys=work_keys)
+
+    def doWork(self, work):
         
         upd_args = {
             'key': work.key,
             'completed': True,
+            'failed': False,
+            'claimed': True,
+            'retry_in': None,
         }
 
+        current_job.key = work.key
+
         try:
-            upd_args['return_value'] = func(*args, **kwargs)
+            # Inside the try so that a job whose function has gone away
+            # fails like any other rather than taking the worker with it
+            func, args, kwargs = pickle.loads(work.work_value)
+
+            result = func(*args, **kwargs)
+            
+            if isinstance(result, FanOut):
+                self.fanOut(work, result)
+                return
+
+            upd_args['return_value'] = json.dumps(result)
             upd_args['cleared'] = True
             upd_args['tb'] = None
         except Exception as e:
@@ -143,40 +1075,250 @@ class ProcessMessage(threading.Thread):
             upd_args['cleared'] = True
             upd_args['return_value'] = json.dumps(upd_args['return_value'])
 
+            if work.attempts < work.max_attempts:
+                # Put it back in line after an exponential backoff
+                upd_args['claimed'] = False
+                upd_args['retry_in'] = work.retry_backoff * 2 ** (work.attempts - 1)
+            else:
+                upd_args['failed'] = True
+
+        finally:
+            current_job.key = None
+
+        if upd_args['completed']:
+            state = 'completed'
+        elif upd_args['failed']:
+            state = 'failed'
+        else:
+            state = 'retrying'
+
         upd = ''' 
                UPDATE work_table SET
                   traceback = :tb,
                   return_value = :return_value,
                   updated = NOW(),
                   completed = :completed,
-                  cleared = :cleared
+                  cleared = :cleared,
+                  failed = :failed,
+                  claimed = :claimed,
+                  lease_expires = NULL,
+                  run_after = NOW() + (:retry_in * INTERVAL '1 second'),
+                  finished_at = CASE WHEN :completed OR :failed THEN NOW() END
                 WHERE key = :key
               '''
         with self.engine.begin() as conn:
             conn.execute(sa.text(upd), **upd_args)
+            publishStatus(conn, work.key, state, retry_in=upd_args['retry_in'])
+
+            if work.parent_key and (upd_args['completed'] or upd_args['failed']):
+                self.childFinished(conn, work.parent_key, upd_args['failed'])
+
+    def fanOut(self, work, fan_out):
+
+        # Children are never coalesced. One that was swapped for a job
+        # already in the queue would report to that job's parent, if any,
+        # and this one would be left waiting on it forever.
+        rows = [workRow(child, args, kwargs, parent_key=work.key, coalesce_key=None)
+                for child, args, kwargs in fan_out.children]
+
+        work_value = None
+        if fan_out.reduce:
+            work_value = pickle.dumps(fan_out.reduce)
+
+        # The parent is left claimed with no lease while it waits on its
+        # children so that nobody claims or reaps it in the meantime.
+        upd = '''
+            UPDATE work_table SET
+              work_value = :work_value,
+              children_total = :children_total,
+              children_done = 0,
+              children_failed = 0,
+              return_value = jsonb_build_object(
+                'children_total', :children_total,
+                'children_done', 0,
+                'children_failed', 0
+              ),
+              traceback = NULL,
+              lease_expires = NULL,
+              updated = NOW()
+            WHERE key = :key
+        '''
+
+        with self.engine.begin() as conn:
+            conn.execute(sa.text(upd),
+                         key=work.key,
+                         work_value=work_value,
+                         children_total=len(rows))
+
+            insertWork(rows, conn=conn)
+
+            publishStatus(conn, work.key, 'running', progress={
+                'children_total': len(rows),
+                'children_done': 0,
+                'children_failed': 0,
+            })
+
+            if not rows:
+                self.childrenFinished(conn, work.key, work_value is not None)
+
+    def childFinished(self, conn, parent_key, failed):
+
+        # The row lock taken here makes siblings that finish at the same
+        # time line up so exactly one of them sees the last child finish.
+        upd = '''
+            UPDATE work_table SET
+              children_done = children_done + 1,
+              children_failed = children_failed + :failed,
+              return_value = jsonb_build_object(
+                'children_total', children_total,
+                'children_done', children_done + 1,
+                'children_failed', children_failed + :failed
+              ),
+              updated = NOW()
+            WHERE key = :parent_key
+            RETURNING
+              children_done,
+              children_total,
+              children_failed,
+              work_value IS NOT NULL AS has_reduce
+        '''
 
-def queue_daemon(): # pragma: no cover
+        parent = conn.execute(sa.text(upd),
+                              parent_key=parent_key,
+                              failed=int(failed)).first()
+
+        if parent:
+            publishStatus(conn, parent_key, 'running', progress={
+                'children_total': parent.children_total,
+                'children_done': parent.children_done,
+                'children_failed': parent.children_failed,
+            })
+
+        if parent and parent.children_done >= parent.children_total:
+            self.childrenFinished(conn, parent_key, parent.has_reduce)
+
+    def childrenFinished(self, conn, parent_key, has_reduce):
+
+        if has_reduce:
+            # Put the parent back in line to run its reduce step. It gets
+            # a fresh set of attempts since the fan out already used one.
+            upd = '''
+                UPDATE work_table SET
+                  claimed = FALSE,
+                  attempts = 0,
+                  run_after = NULL,
+                  updated = NOW()
+                WHERE key = :parent_key
+            '''
+            conn.execute(sa.text(upd), parent_key=parent_key)
+            conn.execute("NOTIFY worker, '{}'".format(parent_key))
+
+        else:
+            upd = '''
+                UPDATE work_table SET
+                  completed = TRUE,
+                  finished_at = NOW(),
+                  updated = NOW()
+                WHERE key = :parent_key
+                RETURNING parent_key
+            '''
+            parent = conn.execute(sa.text(upd), parent_key=parent_key).first()
+            publishStatus(conn, parent_key, 'completed')
+
+            # Fan outs can nest so let the next parent up know
+            if parent and parent.parent_key:
+                self.childFinished(conn, parent.parent_key, False)
+
+class ThreadWorker(WorkerMixin, threading.Thread):
+
+    def __init__(self, stopper, work_queue, **kwargs):
+        super().__init__()
+        self.setup(stopper, work_queue, **kwargs)
+
+
+class ProcessWorker(WorkerMixin, multiprocessing.Process):
+
+    def __init__(self, stopper, work_queue, **kwargs):
+        super().__init__()
+        self.setup(stopper, work_queue, **kwargs)
+
+    def run(self):
+        # Ctrl-C goes to the whole process group. The daemon sets the
+        # stopper when it gets it, which is how we find out to finish up,
+        # so the handler it would otherwise have left us isn't wanted.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        super().run()
+
+
+WORKER_TYPES = {
+    'thread': ThreadWorker,
+    'process': ProcessWorker,
+}
+
+def queue_daemon(worker_count=1,
+                 worker_type='thread',
+                 batch_size=1,
+                 lanes=None): # pragma: no cover
     # import logging
     # logging.getLogger().setLevel(logging.WARNING)
     
-    import signal
     import sys
 
     engine = sa.create_engine(DB_CONN)
     
-    work_table = WorkTable.__table__
-    work_table.create(engine, checkfirst=True)
+    createWorkTable(engine)
+    QueueWorker.__table__.create(engine, checkfirst=True)
+    QueueSchedule.__table__.create(engine, checkfirst=True)
+
+    # Not being able to tidy up work_table shouldn't keep the workers from
+    # starting. It's tried again every hour.
+    try:
+        maintain_work_table()
+    except sa.exc.DBAPIError:
+        traceback.print_exc()
+
+    # Pulls in the periodic jobs defined alongside the rest of the tasks
+    import transcriber.tasks
    
-    stopper = threading.Event()
+    worker_class = WORKER_TYPES[worker_type]
+
+    # Process workers need primitives that survive the fork, threads can
+    # make do with the cheaper in-process versions.
+    if worker_type == 'process':
+        stopper = multiprocessing.Event()
+        work_queue = multiprocessing.Queue()
+    else:
+        stopper = threading.Event()
+        work_queue = queue.Queue()
 
-    worker = ProcessMessage(stopper)
+    listener = ProcessMessage(stopper, work_queue, worker_count=worker_count)
+
+    workers = [worker_class(stopper,
+                            work_queue,
+                            batch_size=batch_size,
+                            lanes=lanes)
+               for _ in range(worker_count)]
 
     def signalHandler(signum, frame):
         stopper.set()
-        worker.join()
+        listener.join()
+
+        for worker in workers:
+            worker.join()
+
         sys.exit(0)
 
     signal.signal(signal.SIGINT, signalHandler)
 
-    print('Starting worker')
-    worker.start()
+    print('Starting {0} {1} worker(s) for {2} lane(s)'.format(worker_count,
+                                                           worker_type,
+                                                           ', '.join(lanes or ['all'])))
+
+    for worker in workers:
+        worker.start()
+
+    listener.start()
+
+    scheduler = Scheduler(stopper)
+    scheduler.start()
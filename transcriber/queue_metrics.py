@@ -0,0 +1,232 @@
+from collections import OrderedDict
+
+import sqlalchemy as sa
+
+from transcriber.queue import LEASE_SECONDS
+
+# Upper bounds, in seconds, of the wait and run time histogram buckets
+HISTOGRAM_BUCKETS = [1, 5, 15, 60, 300, 900, 3600, 14400]
+
+def queueMetrics(engine, window_minutes=60):
+    '''
+    Summarize the health of the work queue from work_table and
+    queue_worker. Depths are for right now. Histograms and failure counts
+    cover the jobs queued in the last window_minutes, which keeps the
+    queries on the newest work_table partition.
+    '''
+
+    depth_query = '''
+        SELECT
+          task_name,
+          COUNT(*) FILTER (WHERE claimed = FALSE AND run_after IS NULL) AS waiting,
+          COUNT(*) FILTER (WHERE claimed = FALSE AND run_after IS NOT NULL) AS retrying,
+          COUNT(*) FILTER (WHERE claimed = TRUE AND lease_expires IS NOT NULL) AS running,
+          COUNT(*) FILTER (WHERE claimed = TRUE AND lease_expires IS NULL) AS fanned_out
+        FROM work_table
+        WHERE completed = FALSE
+          AND failed = FALSE
+        GROUP BY task_name
+        ORDER BY task_name
+    '''
+
+    outcome_query = '''
+        SELECT
+          task_name,
+          COUNT(*) FILTER (WHERE completed = TRUE) AS completed,
+          COUNT(*) FILTER (WHERE failed = TRUE) AS failed,
+          COALESCE(SUM(GREATEST(attempts - 1, 0)), 0) AS retries
+        FROM work_table
+        WHERE created >= NOW() - (:window_minutes * INTERVAL '1 minute')
+        GROUP BY task_name
+        ORDER BY task_name
+    '''
+
+    # Time spent waiting to be claimed and time spent running, bucketed by
+    # the database so only a handful of rows come back per task
+    histogram_query = '''
+        SELECT
+          task_name,
+          width_bucket(seconds, CAST(:buckets AS FLOAT[])) AS bucket,
+          COUNT(*) AS count,
+          SUM(seconds) AS total
+        FROM (
+          SELECT
+            task_name,
+            EXTRACT(EPOCH FROM {0})::FLOAT AS seconds
+          FROM work_table
+          WHERE created >= NOW() - (:window_minutes * INTERVAL '1 minute')
+            AND {1}
+        ) AS s
+        GROUP BY task_name, bucket
+    '''
+
+    worker_query = '''
+        SELECT
+          id,
+          hostname,
+          pid,
+          lanes,
+          started,
+          last_seen,
+          current_key,
+          last_seen >= NOW() - (:stale_seconds * INTERVAL '1 second') AS alive
+        FROM queue_worker
+        ORDER BY hostname, id
+    '''
+
+    params = {
+        'window_minutes': window_minutes,
+        'buckets': HISTOGRAM_BUCKETS,
+    }
+
+    tasks = OrderedDict()
+
+    def task(task_name):
+        if task_name not in tasks:
+            tasks[task_name] = {
+                'waiting': 0,
+                'retrying': 0,
+                'running': 0,
+                'fanned_out': 0,
+                'completed': 0,
+                'failed': 0,
+                'retries': 0,
+                'wait_seconds': emptyHistogram(),
+                'run_seconds': emptyHistogram(),
+            }
+        return tasks[task_name]
+
+    with engine.begin() as conn:
+        for row in conn.execute(sa.text(depth_query)):
+            task(row.task_name).update(waiting=row.waiting,
+                                       retrying=row.retrying,
+                                       running=row.running,
+                                       fanned_out=row.fanned_out)
+
+        for row in conn.execute(sa.text(outcome_query), **params):
+            task(row.task_name).update(completed=row.completed,
+                                       failed=row.failed,
+                                       retries=int(row.retries))
+
+        histograms = [
+            ('wait_seconds', 'claimed_at - created', 'claimed_at IS NOT NULL'),
+            ('run_seconds', 'finished_at - claimed_at', 'finished_at IS NOT NULL'),
+        ]
+
+        for name, interval, condition in histograms:
+            query = histogram_query.format(interval, condition)
+
+            for row in conn.execute(sa.text(query), **params):
+                histogram = task(row.task_name)[name]
+                histogram['buckets'][row.bucket] += row.count
+                histogram['count'] += row.count
+                histogram['sum'] += row.total or 0
+
+        # A worker beats every LEASE_SECONDS / 3 so missing a whole lease
+        # worth of beats means it's gone
+        workers = [dict(row) for row in conn.execute(sa.text(worker_query),
+                                                     stale_seconds=LEASE_SECONDS)]
+
+    return {
+        'window_minutes': window_minutes,
+        'tasks': tasks,
+        'workers': workers,
+        'workers_alive': len([w for w in workers if w['alive']]),
+    }
+
+def emptyHistogram():
+    # width_bucket puts values below the first bound in bucket 0 and values
+    # past the last one in bucket len(HISTOGRAM_BUCKETS)
+    return {
+        'buckets': [0] * (len(HISTOGRAM_BUCKETS) + 1),
+        'count': 0,
+        'sum': 0,
+    }
+
+def prometheusMetrics(metrics):
+    '''
+    Render the output of queueMetrics in the Prometheus text format.
+    '''
+
+    lines = []
+
+    def metric(name, kind, help_text):
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+
+    metric('transcriber_queue_depth', 'gauge',
+           'Jobs in the queue that have not finished, by state')
+
+    for task_name, task in metrics['tasks'].items():
+        for state in ['waiting', 'retrying', 'running', 'fanned_out']:
+            lines.append('transcriber_queue_depth{{task="{0}",state="{1}"}} {2}'
+                         .format(task_name, state, task[state]))
+
+    outcomes = [
+        ('transcriber_queue_completed', 'completed', 'Jobs completed'),
+        ('transcriber_queue_failed', 'failed', 'Jobs that failed on their last attempt'),
+        ('transcriber_queue_retries', 'retries', 'Extra attempts made at jobs'),
+    ]
+
+    for name, key, help_text in outcomes:
+        metric(name, 'gauge', '{0} out of those queued in the last {1} minutes'
+               .format(help_text, metrics['window_minutes']))
+
+        for task_name, task in metrics['tasks'].items():
+            lines.append('{0}{{task="{1}"}} {2}'.format(name, task_name, task[key]))
+
+    # These cover a sliding window so they go down as well as up, which a
+    # Prometheus histogram isn't allowed to do. They're gauges instead,
+    # one for each bucket bound, for the sum and for the count.
+    histograms = [
+        ('transcriber_queue_recent_wait_seconds', 'wait_seconds', 'waited to be claimed'),
+        ('transcriber_queue_recent_run_seconds', 'run_seconds', 'ran'),
+    ]
+
+    for name, key, help_text in histograms:
+        window = metrics['window_minutes']
+
+        metric('{}_le'.format(name), 'gauge',
+               'Jobs queued in the last {0} minutes that {1} for at most le seconds'
+               .format(window, help_text))
+
+        for task_name, task in metrics['tasks'].items():
+            histogram = task[key]
+            cumulative = 0
+
+            for bound, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append('{0}_le{{task="{1}",le="{2}"}} {3}'
+                             .format(name, task_name, bound, cumulative))
+
+            lines.append('{0}_le{{task="{1}",le="+Inf"}} {2}'
+                         .format(name, task_name, histogram['count']))
+
+        metric('{}_sum'.format(name), 'gauge',
+               'Total seconds that jobs queued in the last {0} minutes {1} for'
+               .format(window, help_text))
+
+        for task_name, task in metrics['tasks'].items():
+            lines.append('{0}_sum{{task="{1}"}} {2}'
+                         .format(name, task_name, task[key]['sum']))
+
+        metric('{}_jobs'.format(name), 'gauge',
+               'Jobs queued in the last {0} minutes that {1}'
+               .format(window, help_text))
+
+        for task_name, task in metrics['tasks'].items():
+            lines.append('{0}_jobs{{task="{1}"}} {2}'
+                         .format(name, task_name, task[key]['count']))
+
+    metric('transcriber_queue_worker_up', 'gauge',
+           'Whether a queue worker has checked in recently')
+
+    for worker in metrics['workers']:
+        lines.append('transcriber_queue_worker_up{{worker="{0}"}} {1}'
+                     .format(worker['id'], int(worker['alive'])))
+
+    metric('transcriber_queue_workers_alive', 'gauge',
+           'Number of queue workers that have checked in recently')
+    lines.append('transcriber_queue_workers_alive {}'.format(metrics['workers_alive']))
+
+    return '\n'.join(lines) + '\n'
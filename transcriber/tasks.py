@@ -1,4 +1,7 @@
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+import time
 import json
 import os
 import csv
@@ -6,27 +9,292 @@ import csv
 import sqlalchemy as sa
 
 import boto3
+import botocore
+from botocore.config import Config
 
 from transcriber.app_config import DB_CONN, S3_BUCKET
 from transcriber.models import FormMeta, Image, ImageTaskAssignment
-from transcriber.queue import queuefunc
+from transcriber.manifest import ImageManifest
+from transcriber.queue import queuefunc, periodic, FanOut, reportProgress
 
 engine = sa.create_engine(DB_CONN)
 
-@queuefunc
-def update_from_s3(election_name=None, overwrite=False):
+# How many head_object requests to have going at once when fetching
+# metadata for the keys in an election, and how hard to try when S3 tells
+# us to slow down. Waits start at S3_RETRY_BACKOFF seconds and double.
+try:
+    from transcriber.app_config import S3_METADATA_CONCURRENCY
+except ImportError:
+    S3_METADATA_CONCURRENCY = 16
+
+try:
+    from transcriber.app_config import S3_MAX_RETRIES
+except ImportError:
+    S3_MAX_RETRIES = 5
+
+try:
+    from transcriber.app_config import S3_RETRY_BACKOFF
+except ImportError:
+    S3_RETRY_BACKOFF = 0.5
+
+# How many elections to refresh at once when doing more than one
+try:
+    from transcriber.app_config import ELECTION_REFRESH_PARALLELISM
+except ImportError:
+    ELECTION_REFRESH_PARALLELISM = 4
+
+# Where to keep the local cache of image metadata. Defaults to
+# transcriber/downloads/manifest.sqlite
+try:
+    from transcriber.app_config import IMAGE_MANIFEST_PATH
+except ImportError:
+    IMAGE_MANIFEST_PATH = None
+
+# How many keys to list before saving what we have to the database
+try:
+    from transcriber.app_config import IMAGE_UPSERT_BATCH_SIZE
+except ImportError:
+    IMAGE_UPSERT_BATCH_SIZE = 5000
+
+THROTTLING_ERRORS = set([
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'RequestTimeout',
+    'ServiceUnavailable',
+    'InternalError',
+    '503',
+    '500',
+])
+
+@queuefunc(max_attempts=3, retry_backoff=60, coalesce=True)
+def update_from_s3(election_name=None,
+                   overwrite=False,
+                   keys_per_job=None,
+                   parallelism=None):
+    '''
+    Refresh one election, or the whole bucket when no election_name is
+    given. Bucket wide refreshes fan out into a job per election which run
+    across all the queue workers and then seed image_task_assignment once
+    at the end. With keys_per_job elections are split up further into jobs
+    of about that many keys each. Passing parallelism instead refreshes
+    the whole bucket in this job, that many elections at a time.
+    '''
     updater = ImageUpdater(overwrite=overwrite)
 
+    if election_name and not keys_per_job:
+        report = updater.updateElection(election_name)
+        print('complete!')
+        return report
+
+    if not election_name and parallelism and not keys_per_job:
+        report = updater.updateAllElections(parallelism=parallelism)
+        updater.updateImages()
+        print('complete!')
+        return report
+
     if election_name:
-        updater.updateElection(election_name)
+        elections = [election_name]
     else:
-        updater.updateAllElections()
+        elections = updater.listElections()
+
+    children = []
+
+    for election in elections:
+
+        if keys_per_job:
+            key_ranges = updater.keyRanges(election, keys_per_job)
+        else:
+            key_ranges = [(None, None)]
+
+        for start_after, end_key in key_ranges:
+            children.append((update_election_from_s3, (), {
+                'election_name': election,
+                'overwrite': overwrite,
+                'start_after': start_after,
+                'end_key': end_key,
+            }))
+
+    reduce = None
+    if not election_name:
+        reduce = (update_image_tasks, (), {})
+
+    print('fanning out {} jobs'.format(len(children)))
+
+    return FanOut(children, reduce=reduce)
+
+@queuefunc(max_attempts=3, retry_backoff=60)
+def update_election_from_s3(election_name,
+                            overwrite=False,
+                            start_after=None,
+                            end_key=None):
+    updater = ImageUpdater(overwrite=overwrite)
+    return updater.updateElection(election_name,
+                                  start_after=start_after,
+                                  end_key=end_key)
+
+def update_image_tasks():
+    created = seed_image_tasks()
 
     print('complete!')
 
+    return created
+
+# Images are stamped with the start of the transaction that added them, so
+# one that was still being saved when a form was last seeded can turn up
+# with an earlier stamp. Looking back a bit further than the last seeding
+# catches those and ON CONFLICT takes care of the ones we've already done.
+SEEDING_OVERLAP = 10 * 60
+
+def seed_image_tasks(form_id=None, full=False):
+    '''
+    Give every form, or just form_id, an image_task_assignment for each of
+    the images its election and hierarchy filter pick out. Only images
+    added since the form was last seeded are looked at, unless full is set.
+    Returns how many assignments were created for each form.
+    '''
+
+    # The filter is a 2-D array with a row for each hierarchy that the
+    # form covers, padded out with NULLs. An image belongs to the form if
+    # its hierarchy starts with any one of them.
+    seed = '''
+        WITH forms AS (
+          SELECT
+            id,
+            election_name,
+            hierarchy_filter,
+            images_seeded_through
+          FROM form_meta
+          WHERE status IS DISTINCT FROM 'deleted'
+            AND (CAST(:form_id AS BIGINT) IS NULL OR id = :form_id)
+        ), filters AS (
+          SELECT
+            forms.id AS form_id,
+            ARRAY(
+              SELECT level
+              FROM unnest(forms.hierarchy_filter[r:r]) WITH ORDINALITY AS u (level, n)
+              WHERE level <> ''
+              ORDER BY n
+            ) AS levels
+          FROM forms, generate_subscripts(forms.hierarchy_filter, 1) AS r
+        ), seeded AS (
+          INSERT INTO image_task_assignment (
+            image_id,
+            form_id,
+            is_complete
+          )
+          SELECT
+            image.id AS image_id,
+            forms.id AS form_id,
+            FALSE AS is_complete
+          FROM forms
+          JOIN image
+            ON image.election_name = forms.election_name
+          WHERE image.is_page_url IS NOT TRUE
+            AND (:full
+                 OR forms.images_seeded_through IS NULL
+                 OR image.added > forms.images_seeded_through - (:overlap * INTERVAL '1 second'))
+            AND (NOT EXISTS (
+                   SELECT 1 FROM filters
+                   WHERE filters.form_id = forms.id
+                 )
+                 OR EXISTS (
+                   SELECT 1 FROM filters
+                   WHERE filters.form_id = forms.id
+                     AND image.hierarchy[1:cardinality(filters.levels)] = filters.levels
+                 ))
+          ON CONFLICT ON CONSTRAINT image_to_form
+          DO NOTHING
+          RETURNING form_id
+        ), marked AS (
+          UPDATE form_meta SET
+            images_seeded_through = NOW()
+          FROM forms
+          WHERE form_meta.id = forms.id
+        )
+        SELECT
+          form_id,
+          COUNT(*) AS created
+        FROM seeded
+        GROUP BY form_id
+    '''
+
+    with engine.begin() as conn:
+        rows = conn.execute(sa.text(seed),
+                            form_id=form_id,
+                            full=full,
+                            overlap=SEEDING_OVERLAP)
+
+        created = {row.form_id: row.created for row in rows}
+
+    print('created {} image task assignments'.format(sum(created.values())))
+
+    return created
+
+@periodic(60)
+def release_image_checkouts():
+    '''
+    Hand images whose checkout has run out back to the pool. Nothing relies
+    on this for correctness (an expired checkout is as good as none when
+    picking the next image) but it keeps the column tidy.
+    '''
+
+    update = '''
+        UPDATE image_task_assignment SET
+          checkout_expire = NULL
+        WHERE checkout_expire < NOW()
+    '''
+
+    with engine.begin() as conn:
+        released = conn.execute(update).rowcount
+
+    return {'released': released}
+
+@periodic(2 * 60)
+def rollup_task_progress():
+    '''
+    Work out the progress of every active task ahead of time so the front
+    page doesn't have to run a pile of counts for each task on every load.
+    '''
+
+    tasks = '''
+        SELECT id FROM form_meta
+        WHERE table_name IS NOT NULL
+          AND (status != 'deleted' OR status IS NULL)
+    '''
+
+    upsert = '''
+        INSERT INTO task_progress (form_id, progress, updated)
+        VALUES (:form_id, :progress, NOW())
+        ON CONFLICT (form_id) DO UPDATE SET
+          progress = :progress,
+          updated = NOW()
+    '''
+
+    with engine.begin() as conn:
+        task_ids = [row.id for row in conn.execute(sa.text(tasks))]
+
+        rollups = [{'form_id': task_id,
+                    'progress': json.dumps(ImageTaskAssignment.get_task_progress(task_id,
+                                                                                 engine=conn))}
+                   for task_id in task_ids]
+
+        if rollups:
+            conn.execute(sa.text(upsert), *rollups)
+
+    return {'tasks': len(rollups)}
+
 
 class ImageUpdater(object):
-    def __init__(self, overwrite=False):
+    def __init__(self,
+                 overwrite=False,
+                 concurrency=S3_METADATA_CONCURRENCY,
+                 max_retries=S3_MAX_RETRIES,
+                 retry_backoff=S3_RETRY_BACKOFF,
+                 batch_size=IMAGE_UPSERT_BATCH_SIZE,
+                 client=None,
+                 manifest_path=IMAGE_MANIFEST_PATH):
 
         self.this_folder = os.path.abspath(os.path.dirname(__file__))
 
@@ -35,17 +303,54 @@ class ImageUpdater(object):
         if not os.path.exists(self.download_folder):
             os.mkdir(self.download_folder)
 
-        aws_key, aws_secret_key = self.awsCredentials()
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        # One client for listing, which keeps botocore's retries, and one
+        # shared by all the metadata fetching threads. That one needs a
+        # connection for each of them, for each election being refreshed
+        # at once, and we do its retries ourselves in headObject so that
+        # throttled requests back off for longer.
+        pool_size = concurrency * max(ELECTION_REFRESH_PARALLELISM, 1)
+
+        if client is None:
+            aws_key, aws_secret_key = self.awsCredentials()
+
+            config = Config(max_pool_connections=max(ELECTION_REFRESH_PARALLELISM, 10))
 
-        self.client = boto3.client('s3',
-                                   aws_access_key_id=aws_key,
-                                   aws_secret_access_key=aws_secret_key)
+            client = boto3.client('s3',
+                                  aws_access_key_id=aws_key,
+                                  aws_secret_access_key=aws_secret_key,
+                                  config=config)
+
+            config = Config(max_pool_connections=max(pool_size, 10),
+                            retries={'max_attempts': 0})
+
+            head_client = boto3.client('s3',
+                                       aws_access_key_id=aws_key,
+                                       aws_secret_access_key=aws_secret_key,
+                                       config=config)
+        else:
+            head_client = client
+
+        self.client = client
+        self.head_client = head_client
 
         self.bucket = S3_BUCKET
 
-        self.download_folder = os.path.join(self.this_folder, 'downloads')
         self.overwrite = overwrite
-        self.inserts = []
+        self.batch_size = batch_size
+
+        manifest_path = manifest_path or os.path.join(self.download_folder,
+                                                      'manifest.sqlite')
+
+        self.manifest = ImageManifest(manifest_path)
+
+        imported = self.manifest.importJSON(self.download_folder)
+
+        if imported:
+            print('imported {} cached images into the manifest'.format(imported))
 
     def awsCredentials(self):
         creds_path = os.path.join(self.this_folder, '..', 'credentials.csv')
@@ -62,174 +367,539 @@ class ImageUpdater(object):
 
         return aws_key, aws_secret_key
 
-    @property
-    def image_upsert(self):
+    def updateImages(self, form_id=None):
+        return seed_image_tasks(form_id=form_id)
 
-        return '''
-            INSERT INTO image (
-              id,
-              image_type,
-              fetch_url,
-              election_name,
-              hierarchy,
-              is_page_url,
-              is_current
-            ) VALUES (
-              :id,
-              :image_type,
-              :fetch_url,
-              :election_name,
-              :hierarchy,
-              :is_page_url,
-              :is_current
-            )
-            ON CONFLICT (id) DO UPDATE SET
-              image_type = :image_type,
-              fetch_url = :fetch_url,
-              election_name = :election_name,
-              hierarchy = :hierarchy,
-              is_page_url = :is_page_url,
-              is_current = :is_current
+    def headObject(self, key):
 
-        '''
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.head_client.head_object(Bucket=self.bucket, Key=key)
+            except botocore.exceptions.ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
 
-    def updateImages(self):
+                if code not in THROTTLING_ERRORS or attempt == self.max_retries:
+                    raise
 
-        forms = '''
-            SELECT
-              election_name,
-              id AS form_id
-            FROM form_meta
-        '''
+            # Couldn't connect, timed out or the connection was dropped
+            except (botocore.exceptions.ConnectionError,
+                    botocore.exceptions.HTTPClientError):
+                if attempt == self.max_retries:
+                    raise
 
-        for form in engine.execute(forms):
+            time.sleep(self.retry_backoff * 2 ** attempt)
 
-            insert = '''
-                INSERT INTO image_task_assignment (
-                  image_id,
-                  form_id,
-                  is_complete
-                )
-                SELECT
-                  image.id AS image_id,
-                  :form_id AS form_id,
-                  FALSE AS is_complete
-                FROM image
-                LEFT JOIN image_task_assignment AS ita
-                  ON image.id = ita.image_id
-                WHERE image.election_name = :election_name
-                ON CONFLICT ON CONSTRAINT image_to_form
-                DO NOTHING
-            '''
+    def fetchMetadata(self, objects):
+        '''
+        Metadata for each of a list of (key, etag) pairs, in the same order.
+        Whatever isn't in the manifest already is fetched from S3, up to
+        self.concurrency keys at a time, and saved there.
+        '''
 
-            with engine.begin() as conn:
-                conn.execute(sa.text(insert),
-                             form_id=form.form_id,
-                             election_name=form.election_name)
+        cached = self.manifest.lookup(objects)
 
-    def fetchOrWrite(self, key):
-        image_name = key.split('/', 1)[-1]
+        missing = [(key, etag) for key, etag in objects if key not in cached]
 
-        image_name_json = '{}.json'.format(image_name.rsplit('.', 1)[0])
+        if missing:
+            keys = [key for key, _ in missing]
 
-        json_path = os.path.join(self.download_folder, image_name_json)
+            if self.concurrency <= 1 or len(keys) <= 1:
+                heads = [self.headObject(key) for key in keys]
+            else:
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    heads = list(executor.map(self.headObject, keys))
 
-        if os.path.exists(json_path):
-            return json.load(open(json_path))
+            entries = []
 
-        image = self.client.head_object(Bucket=self.bucket, Key=key)
+            for (key, etag), head in zip(missing, heads):
+                cached[key] = head['Metadata']
+                entries.append((key, head.get('ETag', etag), head['Metadata']))
 
-        with open(json_path, 'w') as f:
-            f.write(json.dumps(image['Metadata']))
+            self.manifest.put(entries)
 
-        return image['Metadata']
+        return [cached[key] for key, _ in objects]
 
-    def updateAllElections(self):
+    def listElections(self):
+        '''
+        Each election is a top level "folder" in the bucket. Asking S3 to
+        roll keys up at the first slash gets us those without listing every
+        key in the bucket.
+        '''
 
-        elections = set()
+        elections = []
 
         params = {
             'Bucket': self.bucket,
+            'Delimiter': '/',
         }
 
-        all_keys = self.client.list_objects_v2(Bucket=self.bucket)
+        while True:
+            prefixes = self.client.list_objects_v2(**params)
+
+            for prefix in prefixes.get('CommonPrefixes', []):
+                elections.append(prefix['Prefix'].rstrip('/'))
+
+            if prefixes['IsTruncated']:
+                params['ContinuationToken'] = prefixes['NextContinuationToken']
+            else:
+                break
+
+        return sorted(elections)
+
+    @staticmethod
+    def electionPrefix(election_name):
+        # Without the slash "foo" would also pick up the keys for "foo-2"
+        return '{}/'.format(election_name)
+
+    def keyRanges(self, election_name, keys_per_range):
+        '''
+        Split an election up into (start_after, end_key) ranges of about
+        keys_per_range keys each, suitable for passing to updateElection.
+        Listing is cheap next to fetching metadata for every key so this
+        just pages through the keys.
+        '''
+
+        ranges = []
+        start_after = None
+        count = 0
+        last_key = None
+
+        params = {
+            'Bucket': self.bucket,
+            'Prefix': self.electionPrefix(election_name),
+        }
 
         while True:
-            for key in all_keys['Contents']:
-                elections.add(key['Key'].split('/', 1)[0])
+            images = self.client.list_objects_v2(**params)
+
+            for key in images.get('Contents', []):
+                count += 1
+                last_key = key['Key']
 
-            if all_keys['IsTruncated']:
-                params['ContinuationToken'] = all_keys['NextContinuationToken']
+                if count == keys_per_range:
+                    ranges.append((start_after, last_key))
+                    start_after = last_key
+                    count = 0
+
+            if images['IsTruncated']:
+                params['ContinuationToken'] = images['NextContinuationToken']
             else:
                 break
 
-            all_keys = self.client.list_objects_v2(**params)
+        if count or not ranges:
+            ranges.append((start_after, None))
+
+        return ranges
+
+    def updateAllElections(self, parallelism=ELECTION_REFRESH_PARALLELISM):
+
+        return self.updateElections(self.listElections(), parallelism=parallelism)
+
+    def updateElections(self, elections, parallelism=ELECTION_REFRESH_PARALLELISM):
+        '''
+        Refresh a list of elections, parallelism of them at a time, and add
+        up what happened.
+        '''
+
+        report = {}
+
+        if parallelism <= 1 or len(elections) <= 1:
+            reports = [self.updateElection(election) for election in elections]
+        else:
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                reports = list(executor.map(self.updateElection, elections))
 
-        for election in elections:
-            self.updateElection(election)
+        for election_report in reports:
+            for name, count in election_report.items():
+                report[name] = report.get(name, 0) + count
 
-    def updateElection(self, election_name):
+        return report
+
+    def updateElection(self, election_name, start_after=None, end_key=None):
+        '''
+        Bring the images for an election, or the part of it after
+        start_after up to and including end_key, in line with S3. Only keys
+        that are new or whose ETag or LastModified changed since the last
+        refresh are fetched and upserted, unless overwrite is set in which
+        case everything is. Images whose keys have gone away are marked as
+        no longer current. Returns counts of what happened.
+
+        Keys are saved in batches of self.batch_size as the listing goes
+        along and where we got to is saved with them, so if this is
+        interrupted the next run over the same range picks up after the
+        last batch that was saved.
+        '''
 
         print('getting images for election {}'.format(election_name))
 
-        self.inserts = []
+        range_key = '{0}|{1}|{2}'.format(election_name,
+                                         start_after or '',
+                                         end_key or '')
+
+        report = {
+            'added': 0,
+            'changed': 0,
+            'unchanged': 0,
+            'overwritten': 0,
+            'removed': 0,
+        }
+
+        checkpoint = self.loadCheckpoint(range_key)
+
+        if checkpoint:
+            print('resuming after {}'.format(checkpoint.last_key))
+            start_after = checkpoint.last_key
+            report.update(checkpoint.report)
+
+        staged = []
 
         params = {
             'Bucket': self.bucket,
-            'Prefix': election_name,
+            'Prefix': self.electionPrefix(election_name),
         }
 
+        if start_after:
+            params['StartAfter'] = start_after
+
         images = self.client.list_objects_v2(**params)
 
-        updated = 0
+        done = False
 
         while True:
 
-            for key in images['Contents']:
+            page = []
+
+            for key in images.get('Contents', []):
+
+                # Keys come back in order so once we're past the end of our
+                # range there is nothing left to do
+                if end_key and key['Key'] > end_key:
+                    done = True
+                    break
 
                 if key['Size'] > 0:
+                    page.append(key)
 
-                    image = self.fetchOrWrite(key['Key'])
+            self.stageKeys(election_name, page, report, staged)
 
-                    self.addToDCInserts(election_name, key['Key'], image)
+            if len(staged) >= self.batch_size:
+                last_key = staged[-1][0]
 
-                    updated += 1
+                self.flushStaged(staged,
+                                 election_name,
+                                 range_key,
+                                 start_after,
+                                 last_key,
+                                 report)
 
-                    if updated % 100 is 0:
-                        print('fetched {}'.format(updated))
+                start_after = last_key
 
-            if images['IsTruncated']:
+                # Anyone following the job gets to see how it's going
+                reportProgress(election_name=election_name, **report)
+
+            if images['IsTruncated'] and not done:
                 params['ContinuationToken'] = images['NextContinuationToken']
             else:
                 break
 
             images = self.client.list_objects_v2(**params)
 
-        if self.inserts:
-            with engine.begin() as conn:
-                conn.execute(sa.text(self.image_upsert), *self.inserts)
+        self.flushStaged(staged,
+                         election_name,
+                         range_key,
+                         start_after,
+                         end_key,
+                         report,
+                         finished=True)
+
+        print('{added} added, {changed} changed, {unchanged} unchanged, '
+              '{overwritten} overwritten, {removed} removed'.format(**report))
+
+        return report
+
+    def loadCheckpoint(self, range_key):
+
+        checkpoint = '''
+            SELECT last_key, report
+            FROM image_sync_checkpoint
+            WHERE range_key = :range_key
+        '''
+
+        with engine.begin() as conn:
+            return conn.execute(sa.text(checkpoint),
+                                range_key=range_key).first()
+
+    def stageKeys(self, election_name, page, report, staged):
+        '''
+        Work out which of a page of listed keys are new or changed, fetch
+        metadata for those and add the lot to staged.
+        '''
+
+        known = '''
+            SELECT key, etag, last_modified
+            FROM image_object
+            WHERE key = ANY(:keys)
+        '''
+
+        with engine.begin() as conn:
+            rows = conn.execute(sa.text(known), keys=[key['Key'] for key in page])
+            known = {row.key: row for row in rows}
+
+        changed = []
+        replaced = []
+
+        for key in page:
+            previous = known.get(key['Key'])
+
+            if previous is None:
+                report['added'] += 1
+            elif previous.etag != key['ETag'] \
+                    or previous.last_modified != key['LastModified']:
+                report['changed'] += 1
+
+                # Whatever the manifest has for it is about the old object
+                replaced.append(key['Key'])
+            elif not self.overwrite:
+                report['unchanged'] += 1
+
+                # Still staged so that we know it hasn't gone away
+                staged.append((key['Key'], False) + (None,) * 8)
+                continue
+            else:
+                report['overwritten'] += 1
+
+            changed.append(key)
+
+        objects = [(key['Key'], key['ETag']) for key in changed]
+
+        if self.overwrite:
+            self.manifest.invalidate([k for k, _ in objects])
+        elif replaced:
+            self.manifest.invalidate(replaced)
+
+        # Each page is up to 1000 keys so fetch their metadata all at
+        # once rather than one round trip after another
+        metadata = self.fetchMetadata(objects)
+
+        for key, image in zip(changed, metadata):
+            staged.append(self.stagedImage(election_name, key, image))
+
+        if changed:
+            print('fetched {}'.format(report['added']
+                                      + report['changed']
+                                      + report['overwritten']))
 
-    def addToDCInserts(self,
-                       election_name,
-                       image_key,
-                       image_metadata):
+    def stagedImage(self, election_name, key, image_metadata):
 
         fetch_url_fmt = 'https://s3.amazonaws.com/{bucket}/{key}'
 
         fetch_url = fetch_url_fmt.format(bucket=self.bucket,
-                                         key=image_key)
+                                         key=key['Key'])
+
+        # Stays JSON until it's merged into image.hierarchy
+        hierarchy = image_metadata.get('hierarchy') or None
+
+        return (key['Key'],
+                True,
+                image_metadata['image_id'],
+                'pdf',
+                fetch_url,
+                hierarchy,
+                False,
+                True,
+                key['ETag'],
+                key['LastModified'])
+
+    def flushStaged(self,
+                    staged,
+                    election_name,
+                    range_key,
+                    from_key,
+                    to_key,
+                    report,
+                    finished=False):
+        '''
+        Save the staged keys, and retire the ones in image_object between
+        from_key and to_key that weren't among them, in one transaction
+        along with the checkpoint for the range. The staged rows are copied
+        into a temporary table and merged from there which is a lot quicker
+        than an executemany of upserts.
+        '''
 
-        hierarchy = None
+        create_staging = '''
+            CREATE TEMP TABLE image_staging (
+              key VARCHAR,
+              changed BOOLEAN,
+              id UUID,
+              image_type VARCHAR,
+              fetch_url VARCHAR,
+              hierarchy JSONB,
+              is_page_url BOOLEAN,
+              is_current BOOLEAN,
+              etag VARCHAR,
+              last_modified TIMESTAMP WITH TIME ZONE
+            ) ON COMMIT DROP
+        '''
 
-        if image_metadata.get('hierarchy'):
-            hierarchy = json.loads(image_metadata['hierarchy'])
+        copy = '''
+            COPY image_staging (
+              key,
+              changed,
+              id,
+              image_type,
+              fetch_url,
+              hierarchy,
+              is_page_url,
+              is_current,
+              etag,
+              last_modified
+            ) FROM STDIN WITH CSV
+        '''
+
+        # The same image can turn up under more than one key
+        merge_images = '''
+            INSERT INTO image (
+              id,
+              image_type,
+              fetch_url,
+              election_name,
+              hierarchy,
+              is_page_url,
+              is_current
+            )
+            SELECT DISTINCT ON (id)
+              id,
+              image_type,
+              fetch_url,
+              :election_name,
+              CASE WHEN hierarchy IS NULL THEN NULL
+                ELSE ARRAY(SELECT jsonb_array_elements_text(hierarchy))
+              END,
+              is_page_url,
+              is_current
+            FROM image_staging
+            WHERE changed
+            ORDER BY id, key DESC
+            ON CONFLICT (id) DO UPDATE SET
+              image_type = EXCLUDED.image_type,
+              fetch_url = EXCLUDED.fetch_url,
+              election_name = EXCLUDED.election_name,
+              hierarchy = EXCLUDED.hierarchy,
+              is_page_url = EXCLUDED.is_page_url,
+              is_current = EXCLUDED.is_current
+        '''
+
+        merge_objects = '''
+            INSERT INTO image_object (
+              key,
+              election_name,
+              image_id,
+              etag,
+              last_modified
+            )
+            SELECT
+              key,
+              :election_name,
+              id,
+              etag,
+              last_modified
+            FROM image_staging
+            WHERE changed
+            ON CONFLICT (key) DO UPDATE SET
+              election_name = EXCLUDED.election_name,
+              image_id = EXCLUDED.image_id,
+              etag = EXCLUDED.etag,
+              last_modified = EXCLUDED.last_modified
+        '''
+
+        # S3 lists keys in byte order so the range has to be compared the
+        # same way rather than in the database's collation. The same image
+        # can turn up under more than one key so it's only retired once
+        # none of its keys are left.
+        retire = '''
+            WITH vanished AS (
+              DELETE FROM image_object AS o
+              WHERE o.election_name = :election_name
+                AND (CAST(:from_key AS VARCHAR) IS NULL
+                     OR o.key COLLATE "C" > CAST(:from_key AS VARCHAR))
+                AND (CAST(:to_key AS VARCHAR) IS NULL
+                     OR o.key COLLATE "C" <= CAST(:to_key AS VARCHAR))
+                AND NOT EXISTS (
+                  SELECT 1 FROM image_staging AS s
+                  WHERE s.key = o.key
+                )
+              RETURNING o.key, o.image_id
+            ), retired AS (
+              UPDATE image SET
+                is_current = FALSE
+              FROM vanished
+              WHERE image.id = vanished.image_id
+                AND NOT EXISTS (
+                  SELECT 1 FROM image_object AS o2
+                  WHERE o2.image_id = vanished.image_id
+                    AND o2.key <> vanished.key
+                    -- Still there as far as this statement can see
+                    AND o2.key NOT IN (SELECT key FROM vanished)
+                )
+            )
+            SELECT key FROM vanished
+        '''
+
+        save_checkpoint = '''
+            INSERT INTO image_sync_checkpoint (
+              range_key,
+              last_key,
+              report,
+              updated
+            ) VALUES (
+              :range_key,
+              :last_key,
+              :report,
+              NOW()
+            )
+            ON CONFLICT (range_key) DO UPDATE SET
+              last_key = :last_key,
+              report = :report,
+              updated = NOW()
+        '''
+
+        clear_checkpoint = '''
+            DELETE FROM image_sync_checkpoint
+            WHERE range_key = :range_key
+        '''
+
+        buf = StringIO()
+        writer = csv.writer(buf)
+        writer.writerows(staged)
+        buf.seek(0)
+
+        params = {
+            'election_name': election_name,
+            'from_key': from_key,
+            'to_key': to_key,
+        }
+
+        with engine.begin() as conn:
+            conn.execute(sa.text(create_staging))
+
+            curs = conn.connection.cursor()
+            curs.copy_expert(copy, buf)
+
+            conn.execute(sa.text(merge_images), **params)
+            conn.execute(sa.text(merge_objects), **params)
+
+            vanished = [row.key for row in conn.execute(sa.text(retire), **params)]
+
+            report['removed'] += len(vanished)
+
+            if finished:
+                conn.execute(sa.text(clear_checkpoint), range_key=range_key)
+            else:
+                conn.execute(sa.text(save_checkpoint),
+                             range_key=range_key,
+                             last_key=to_key,
+                             report=json.dumps(report))
 
-        values = dict(image_type='pdf',
-                      fetch_url=fetch_url,
-                      election_name=election_name,
-                      id=image_metadata['image_id'],
-                      hierarchy=hierarchy,
-                      is_page_url=False,
-                      is_current=True)
+        self.manifest.invalidate(vanished)
 
-        self.inserts.append(values)
+        del staged[:]
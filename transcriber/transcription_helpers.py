@@ -190,7 +190,8 @@ class TranscriptionManager(object):
               USING(image_id)
             WHERE ita.form_id = :form_id
               AND ita.is_complete = FALSE
-              AND ita.checkout_expire IS NULL
+              AND (ita.checkout_expire IS NULL OR
+                   ita.checkout_expire < NOW())
               AND (data.transcriber != :user OR
                    data.image_id IS NULL)
               AND ita.view_count < :reviewer_count
@@ -385,16 +386,3 @@ class TranscriptionManager(object):
 
         return incomplete_count > 0
 
-def checkinImages():
-
-    update = '''
-        UPDATE image_task_assignment SET
-          checkout_expire = NULL
-        WHERE checkout_expire < NOW()
-    '''
-
-    engine = db.session.bind
-
-    with engine.begin() as conn:
-        conn.execute(update)
-
@@ -1,12 +1,14 @@
 import ast
 import json
+import queue
+import time
 from operator import itemgetter
 from io import StringIO
 from datetime import datetime
 
 from flask import Blueprint, make_response, request, render_template, \
     url_for, send_from_directory, session as flask_session, redirect, flash, \
-    jsonify
+    jsonify, Response
 from flask_security.decorators import login_required, roles_required
 from flask_security.core import current_user
 from flask.ext.principal import Permission, RoleNeed
@@ -14,15 +16,22 @@ from flask.ext.principal import Permission, RoleNeed
 from sqlalchemy import Table, MetaData, text, or_
 
 from transcriber.app_config import UPLOAD_FOLDER
+
+try:
+    from transcriber.app_config import METRICS_TOKEN
+except ImportError:
+    METRICS_TOKEN = None
 from transcriber.models import FormMeta, FormSection, FormField, \
     Image, ImageTaskAssignment, TaskGroup
 from transcriber.database import db
 from transcriber.helpers import pretty_task_transcriptions, \
     get_user_activity, getTranscriptionSelect
 
-from transcriber.transcription_helpers import TranscriptionManager, checkinImages
+from transcriber.transcription_helpers import TranscriptionManager
 from transcriber.form_creator_helpers import FormCreatorManager
-from transcriber.tasks import ImageUpdater, update_from_s3
+from transcriber.tasks import update_from_s3, seed_image_tasks
+from transcriber.queue_metrics import queueMetrics, prometheusMetrics
+from transcriber.queue import statusListener
 from transcriber.models import User, Role
 
 views = Blueprint('views', __name__)
@@ -61,7 +70,7 @@ def index():
             reviewer_count = task_dict['reviewer_count']
             task_id = task_dict['id']
 
-            progress_dict = ImageTaskAssignment.get_task_progress(task_id)
+            progress_dict = ImageTaskAssignment.get_rolled_up_task_progress(task_id)
 
             if task.task_group_id not in groups and progress_dict['docs_done_ct'] < progress_dict['docs_total']:
                 is_top_task = True
@@ -281,8 +290,7 @@ def form_creator():
 
         creator_manager.saveFormParts()
 
-        updater = ImageUpdater()
-        updater.updateImages()
+        seed_image_tasks(form_id=creator_manager.form_meta.id)
 
         return redirect(url_for('views.index'))
 
@@ -397,8 +405,6 @@ def transcribe(task_id):
         transcription_task.prepopulateFields()
         edit_mode = True
 
-    checkinImages()
-
     if request.method == 'POST':
 
         if transcription_task.validateTranscription(request.form):
@@ -678,9 +684,16 @@ def viewer():
 @login_required
 @manager_permission.require()
 def refresh_project():
-    project_title = request.args.get('project_title')
-
-    key = update_from_s3.delay(project_title=project_title)
+    election_name = request.args.get('election_name')
+
+    if election_name:
+        # Someone is sitting in front of the form creator waiting on this
+        # one so put it ahead of any bucket wide refreshes.
+        key = update_from_s3.enqueue(kwargs={'election_name': election_name},
+                                     priority=10,
+                                     lane='interactive')
+    else:
+        key = update_from_s3.delay()
 
     flask_session['refresh_key'] = key
 
@@ -696,10 +709,18 @@ def check_work():
     key = flask_session['refresh_key']
 
     engine = db.session.bind
-    complete = engine.execute(text('select completed from work_table where key = :key'), key=key).first()
+    complete = engine.execute(text('''
+        select completed, return_value, children_total
+        from work_table where key = :key
+    '''), key=key).first()
 
     result = {'completed': complete.completed}
 
+    # Bucket wide refreshes are split up into a job per election and keep
+    # track of how many of those are done
+    if complete.children_total and not complete.completed:
+        result['progress'] = complete.return_value
+
     if complete.completed == True:
         del flask_session['refresh_key']
 
@@ -707,3 +728,102 @@ def check_work():
     response.headers['Content-Type'] = 'application/json'
     return response
 
+# Event streams are closed after this long, with a comment every
+# WORK_EVENTS_KEEPALIVE seconds to keep proxies from giving up on them, and
+# the browser waits WORK_EVENTS_RETRY milliseconds before reconnecting.
+# Statuses come from the one StatusListener in each web process so an open
+# stream only costs a thread, but that does mean the app needs to run
+# under a threaded worker, see DEPLOYMENT.md.
+WORK_EVENTS_TIMEOUT = 55
+WORK_EVENTS_KEEPALIVE = 15
+WORK_EVENTS_RETRY = 2000
+
+@views.route('/work-events/')
+@login_required
+@manager_permission.require()
+def work_events():
+    '''
+    Stream status updates for the current refresh job to the browser as
+    server sent events, as the queue workers publish them.
+    '''
+
+    key = flask_session.get('refresh_key')
+
+    if not key:
+        return make_response('', 204)
+
+    listener = statusListener()
+
+    # Subscribed before looking the job up so nothing published in
+    # between is missed
+    waiter = listener.subscribe(key)
+
+    engine = db.session.bind
+    work = engine.execute(text('''
+        SELECT completed, failed, claimed, return_value
+        FROM work_table
+        WHERE key = :key
+    '''), key=key).first()
+
+    # A 204 tells the browser to stop reconnecting
+    if not work:
+        listener.unsubscribe(key, waiter)
+        return make_response('', 204)
+
+    if work.completed:
+        status = {'key': key, 'state': 'completed'}
+    elif work.failed:
+        status = {'key': key, 'state': 'failed'}
+    else:
+        status = {'key': key,
+                  'state': 'running' if work.claimed else 'waiting',
+                  'progress': work.return_value}
+
+    def events(status):
+        yield 'retry: {0}\ndata: {1}\n\n'.format(WORK_EVENTS_RETRY,
+                                                  json.dumps(status, default=str))
+
+        if status['state'] in ('completed', 'failed'):
+            return
+
+        deadline = time.time() + WORK_EVENTS_TIMEOUT
+
+        while time.time() < deadline:
+            timeout = min(deadline - time.time(), WORK_EVENTS_KEEPALIVE)
+
+            try:
+                status = waiter.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+
+            yield 'data: {}\n\n'.format(json.dumps(status, default=str))
+
+            if status['state'] in ('completed', 'failed'):
+                return
+
+    response = Response(events(status), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(lambda: listener.unsubscribe(key, waiter))
+    return response
+
+@views.route('/queue-status/')
+@login_required
+@roles_required('admin')
+def queue_status():
+    metrics = queueMetrics(db.session.bind)
+
+    return render_template('queue-status.html', metrics=metrics)
+
+@views.route('/metrics')
+def metrics():
+    # Meant for a Prometheus style scraper rather than a person so it
+    # checks for a token instead of a login
+    if not METRICS_TOKEN or request.args.get('token') != METRICS_TOKEN:
+        return make_response('Forbidden', 403)
+
+    response = make_response(prometheusMetrics(queueMetrics(db.session.bind)))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
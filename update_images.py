@@ -1,15 +1,30 @@
 
 if __name__ == "__main__":
-    from transcriber.tasks import ImageUpdater
+    from transcriber.tasks import ImageUpdater, ELECTION_REFRESH_PARALLELISM
 
     import argparse
     parser = argparse.ArgumentParser(description='Update images from document cloud')
     parser.add_argument('--overwrite',
                         action='store_true',
-                        help='Overwrite images with newer versions on the server')
+                        help='Fetch and save every image again, even ones that have not changed')
+    parser.add_argument('--election',
+                        action='append',
+                        help='Only refresh this election. Can be given more than once')
+    parser.add_argument('--parallelism',
+                        type=int,
+                        default=ELECTION_REFRESH_PARALLELISM,
+                        help='How many elections to refresh at once')
 
     args = parser.parse_args()
 
     updater = ImageUpdater(overwrite=args.overwrite)
-    updater.updateAllElections()
+
+    if args.election:
+        report = updater.updateElections(args.election,
+                                         parallelism=args.parallelism)
+    else:
+        report = updater.updateAllElections(parallelism=args.parallelism)
+
+    print('{added} added, {changed} changed, {unchanged} unchanged, '
+          '{overwritten} overwritten, {removed} removed'.format(**report))
     updater.updateImages()